@@ -0,0 +1,114 @@
+import re
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """Lowercase words of a text; punctuation and extra whitespace are dropped."""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def normalize_phrase(text):
+    """Normalized form of an attribute value, e.g. '  Black  T-Shirt ' -> 'black t shirt'."""
+    return " ".join(tokenize(text or ""))
+
+
+class PhraseAutomaton:
+    """Word-level Aho-Corasick automaton that finds every vocabulary phrase in a token list in one pass."""
+
+    def __init__(self, phrases):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]  # Phrases (as token counts and text) that end at each node
+        for phrase in phrases:
+            self._add(phrase)
+        self._build()
+
+    def _add(self, phrase):
+        tokens = phrase.split()
+        node = 0
+        for token in tokens:
+            if token not in self.goto[node]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[node][token] = len(self.goto) - 1
+            node = self.goto[node][token]
+        self.output[node].append((len(tokens), phrase))
+
+    def _build(self):
+        """Breadth-first pass that sets the failure links and merges the outputs of suffix phrases."""
+        queue = list(self.goto[0].values())
+        while queue:
+            next_queue = []
+            for node in queue:
+                for token, child in self.goto[node].items():
+                    fallback = self.fail[node]
+                    while fallback and token not in self.goto[fallback]:
+                        fallback = self.fail[fallback]
+                    self.fail[child] = self.goto[fallback].get(token, 0)
+                    self.output[child] = self.output[child] + self.output[self.fail[child]]
+                    next_queue.append(child)
+            queue = next_queue
+
+    def find_all(self, tokens):
+        """Every (start, end, phrase) occurrence in tokens, overlapping ones included."""
+        matches = []
+        node = 0
+        for end, token in enumerate(tokens, 1):
+            while node and token not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(token, 0)
+            for length, phrase in self.output[node]:
+                matches.append((end - length, end, phrase))
+        return matches
+
+    def find_longest(self, tokens):
+        """Leftmost-longest, non-overlapping phrases in tokens, so 'black' is not reported inside 'black uniform'."""
+        found = set()
+        covered_until = 0
+        for start, end, phrase in sorted(self.find_all(tokens), key=lambda m: (m[0], -(m[1] - m[0]))):
+            if start >= covered_until:
+                found.add(phrase)
+                covered_until = end
+        return found
+
+
+class AttributeMatcher:
+    """Matches prompts to IDs by color and action, built from {id: {'color', 'action'}}.
+
+    expression.process_video builds one per video with an entry per prompt_gen attribute span, keyed by the span's
+    index, so a class that changes attributes is matched state by state. An ID matches a prompt when its color
+    phrase (if any) and its action phrase (if any) both occur in the prompt as whole words, using leftmost-longest
+    matching so shorter phrases inside longer ones don't count.
+    """
+
+    def __init__(self, element_data):
+        self.color_ids = {}  # Normalized color phrase -> class IDs
+        self.action_ids = {}  # Normalized action phrase -> class IDs
+        self.no_color_ids = set()
+        self.no_action_ids = set()
+        for cls_id, attributes in element_data.items():
+            color = normalize_phrase(attributes.get('color'))
+            action = normalize_phrase(attributes.get('action'))
+            if color:
+                self.color_ids.setdefault(color, set()).add(cls_id)
+            else:
+                self.no_color_ids.add(cls_id)
+            if action:
+                self.action_ids.setdefault(action, set()).add(cls_id)
+            else:
+                self.no_action_ids.add(cls_id)
+        self.colors = PhraseAutomaton(self.color_ids)
+        self.actions = PhraseAutomaton(self.action_ids)
+
+    def match(self, prompt):
+        """Sorted IDs whose attributes appear in the prompt."""
+        tokens = tokenize(prompt)
+        color_ok = set(self.no_color_ids)
+        for phrase in self.colors.find_longest(tokens):
+            color_ok |= self.color_ids[phrase]
+        action_ok = set(self.no_action_ids)
+        for phrase in self.actions.find_longest(tokens):
+            action_ok |= self.action_ids[phrase]
+        return sorted(color_ok & action_ok)
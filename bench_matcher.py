@@ -0,0 +1,79 @@
+import argparse
+import random
+import time
+
+from attribute_matcher import AttributeMatcher
+from expression import find_matching_ids
+
+COLORS = ["black", "white", "red", "blue", "green", "yellow", "grey", "brown", "pink", "orange", "purple", "navy"]
+GARMENTS = ["jacket", "shirt", "uniform", "t-shirt", "coat", "hoodie", "dress", "sweater", "vest", "apron"]
+ACTIONS = ["checking out", "waiting checkout", "walking", "standing", "buying", "working", "talking on the phone",
+           "carrying a basket", "pushing a cart", "paying", "looking at shelves", "scanning items"]
+TEMPLATES = [
+    "A person wearing a {color} who is {action}.",
+    "{action} person in a {color}.",
+    "Someone with a {color}, {action}.",
+    "A person in a {color} engaged in {action}.",
+]
+
+
+def make_elements(num_classes, rng):
+    """Synthetic {class_id: {'color', 'action'}} data; some classes leave color or action empty like real CSV rows do."""
+    element_data = {}
+    for cls_id in range(1, num_classes + 1):
+        color = f"{rng.choice(COLORS)} {rng.choice(GARMENTS)}" if rng.random() > 0.05 else ""
+        action = rng.choice(ACTIONS) if rng.random() > 0.05 else ""
+        element_data[cls_id] = {'color': color, 'action': action}
+    return element_data
+
+
+def make_prompts(element_data, num_prompts, rng):
+    """Prompts generated from random classes, the way prompt_gen.generate_prompts writes them."""
+    prompts = []
+    classes = list(element_data.values())
+    for _ in range(num_prompts):
+        attributes = rng.choice(classes)
+        color = attributes['color'] or rng.choice(COLORS)
+        action = attributes['action'] or rng.choice(ACTIONS)
+        prompt = rng.choice(TEMPLATES).format(color=color, action=action)
+        prompts.append(prompt[0].upper() + prompt[1:])
+    return prompts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark AttributeMatcher against the substring scan")
+    parser.add_argument("--classes", type=int, default=5000)
+    parser.add_argument("--prompts", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    element_data = make_elements(args.classes, rng)
+    prompts = make_prompts(element_data, args.prompts, rng)
+
+    start = time.perf_counter()
+    baseline = [set(find_matching_ids(prompt, element_data)) for prompt in prompts]
+    baseline_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher = AttributeMatcher(element_data)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    indexed = [set(matcher.match(prompt)) for prompt in prompts]
+    match_time = time.perf_counter() - start
+
+    # Every ID the matcher returns must also be a substring match; the difference is the false positives it drops
+    assert all(ids <= reference for ids, reference in zip(indexed, baseline))
+    baseline_ids = sum(len(ids) for ids in baseline)
+    indexed_ids = sum(len(ids) for ids in indexed)
+
+    print(f"{args.classes} classes, {args.prompts} prompts")
+    print(f"substring scan:   {baseline_time:8.3f}s  ({baseline_ids} IDs)")
+    print(f"matcher build:    {build_time:8.3f}s")
+    print(f"matcher queries:  {match_time:8.3f}s  ({indexed_ids} IDs)")
+    print(f"speedup:          {baseline_time / max(match_time + build_time, 1e-9):8.1f}x")
+    print(f"dropped substring-only matches: {baseline_ids - indexed_ids}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import argparse
+import os
+import time
+
+import cv2
+
+from detector_backends import BACKENDS, load_backend
+from tracker import iou
+
+
+def load_frames(source, max_frames=64, frame_interval=0.5):
+    """Đọc tối đa max_frames frame từ thư mục ảnh (vd. images/0000) hoặc từ một video."""
+    frames = []
+    if os.path.isdir(source):
+        for file in sorted(os.listdir(source)):
+            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
+                frames.append(cv2.imread(os.path.join(source, file)))
+                if len(frames) >= max_frames:
+                    break
+        return frames
+
+    cap = cv2.VideoCapture(source)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    step = max(1, int(frame_interval * fps))
+    frame_index = 0
+    while len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if frame_index % step == 0:
+            frames.append(frame)
+        frame_index += 1
+    cap.release()
+    return frames
+
+
+def time_backend(backend, frames, batch_size, conf_threshold, warmup=2):
+    """Chạy backend trên toàn bộ frames theo batch; trả về (detections, giây/frame)."""
+    for _ in range(warmup):
+        backend.detect(frames[:batch_size], conf_threshold)
+    detections = []
+    start = time.perf_counter()
+    for i in range(0, len(frames), batch_size):
+        detections.extend(backend.detect(frames[i:i + batch_size], conf_threshold))
+    elapsed = time.perf_counter() - start
+    return detections, elapsed / max(1, len(frames))
+
+
+def match_boxes(reference, candidate, iou_threshold=0.5):
+    """Ghép tham lam box của hai backend theo IoU; trả về (số cặp khớp, tổng IoU của các cặp khớp)."""
+    pairs = []
+    for r, ref_box in enumerate(reference):
+        for c, cand_box in enumerate(candidate):
+            overlap = iou(ref_box, cand_box)
+            if overlap >= iou_threshold:
+                pairs.append((overlap, r, c))
+    pairs.sort(reverse=True)
+    used_ref, used_cand = set(), set()
+    total_iou = 0.0
+    for overlap, r, c in pairs:
+        if r in used_ref or c in used_cand:
+            continue
+        used_ref.add(r)
+        used_cand.add(c)
+        total_iou += overlap
+    return len(used_ref), total_iou
+
+
+def agreement(reference, candidate, iou_threshold=0.5):
+    """Precision/recall/IoU trung bình của candidate so với reference (backend torch) trên mọi frame."""
+    matched = ref_total = cand_total = 0
+    total_iou = 0.0
+    for (ref_xywhn, _), (cand_xywhn, _) in zip(reference, candidate):
+        ref_boxes, cand_boxes = ref_xywhn.tolist(), cand_xywhn.tolist()
+        frame_matched, frame_iou = match_boxes(ref_boxes, cand_boxes, iou_threshold)
+        matched += frame_matched
+        total_iou += frame_iou
+        ref_total += len(ref_boxes)
+        cand_total += len(cand_boxes)
+    precision = matched / cand_total if cand_total else 1.0
+    recall = matched / ref_total if ref_total else 1.0
+    mean_iou = total_iou / matched if matched else 0.0
+    return precision, recall, mean_iou
+
+
+def main():
+    parser = argparse.ArgumentParser(description="So sánh tốc độ và độ khớp box của các backend suy luận CPU")
+    parser.add_argument("source", help="Thư mục ảnh (vd. images/0000) hoặc file video")
+    parser.add_argument("--model", default="yolov8l.pt", help="Đường dẫn model YOLOv8 (.pt)")
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--frames", type=int, default=64, help="Số frame dùng để đo")
+    parser.add_argument("--conf-threshold", type=float, default=0.0)
+    parser.add_argument("--iou", type=float, default=0.5, help="IoU tối thiểu để coi hai box là khớp")
+    args = parser.parse_args()
+
+    frames = load_frames(args.source, args.frames)
+    if not frames:
+        raise SystemExit(f"No frames found in {args.source}")
+    print(f"Loaded {len(frames)} frames from {args.source}")
+
+    # Backend torch luôn chạy để làm mốc so sánh
+    names = ["torch"] + [name for name in args.backends if name != "torch"]
+    baseline = None
+    baseline_time = None
+    print(f"{'backend':<10} {'ms/frame':>9} {'fps':>7} {'speedup':>8} {'precision':>10} {'recall':>7} {'mean IoU':>9}")
+    for name in names:
+        backend = load_backend(args.model, name, args.imgsz, args.threads)
+        detections, seconds = time_backend(backend, frames, args.batch_size, args.conf_threshold)
+        if baseline is None:
+            baseline, baseline_time = detections, seconds
+        precision, recall, mean_iou = agreement(baseline, detections, args.iou)
+        print(f"{name:<10} {seconds * 1000:>9.1f} {1 / seconds:>7.2f} {baseline_time / seconds:>7.2f}x "
+              f"{precision:>10.3f} {recall:>7.3f} {mean_iou:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""Các backend suy luận CPU cho pre_label_tool, cùng một giao diện detect().
+
+    backend.detect(frames, conf_threshold) -> [(xywhn [N, 4], conf [N]), ...]
+
+trả về box person (class 0) đã chuẩn hóa theo kích thước frame, mỗi phần tử ứng với một frame đầu vào.
+
+    "torch"     - YOLO của ultralytics chạy PyTorch (như cũ).
+    "onnx"      - model export sang ONNX, chạy bằng ONNX Runtime (pip install onnxruntime).
+    "onnx-int8" - như "onnx" nhưng trọng số được lượng tử hóa động sang int8.
+
+CascadeBackend ghép hai backend: model nhỏ chạy mọi frame, model lớn chỉ chạy lại các frame không chắc chắn.
+
+File .onnx được export (và lượng tử hóa) một lần, đặt cạnh file .pt và dùng lại ở các lần chạy sau.
+"""
+import os
+
+import cv2
+import numpy as np
+
+PERSON_CLASS = 0  # Chỉ lấy bounding box của class "person"
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+def person_detections(result, conf_threshold=0.0):
+    """Lọc box person của một Results bằng mask trên mảng; trả về (xywhn [N, 4], conf [N]) đã chuẩn hóa."""
+    boxes = result.boxes
+    # Mỗi thuộc tính chỉ chuyển tensor -> numpy một lần cho cả frame thay vì index từng box
+    xywhn = boxes.xywhn.cpu().numpy()
+    cls = boxes.cls.cpu().numpy()
+    conf = boxes.conf.cpu().numpy()
+    mask = (cls == PERSON_CLASS) & (conf >= conf_threshold)
+    return xywhn[mask], conf[mask]
+
+
+class UltralyticsBackend:
+    """YOLO của ultralytics chạy PyTorch trên CPU."""
+
+    def __init__(self, model_path="yolov8l.pt", imgsz=640, threads=None, conf=0.25):
+        from ultralytics import YOLO
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        self.model = YOLO(model_path)
+        self.imgsz = imgsz
+        self.conf = conf  # Ngưỡng confidence khi predict (mặc định của ultralytics)
+
+    def detect(self, frames, conf_threshold=0.0):
+        # Ultralytics nhận list ảnh và trả về một Results cho mỗi ảnh, đúng thứ tự đầu vào
+        results = self.model(frames, imgsz=self.imgsz, conf=self.conf)
+        return [person_detections(result, conf_threshold) for result in results]
+
+
+class OnnxRuntimeBackend:
+    """Model YOLOv8 dạng ONNX chạy bằng ONNX Runtime; tự letterbox, giải mã đầu ra và NMS như ultralytics."""
+
+    def __init__(self, onnx_path, imgsz=640, threads=None, conf=0.25, iou=0.7):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("The onnx backends need onnxruntime: pip install onnxruntime") from e
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.imgsz = imgsz
+        # Ngưỡng mặc định giống ultralytics để kết quả so sánh được với backend torch
+        self.conf = conf
+        self.iou = iou
+
+    def _letterbox(self, frame):
+        """Resize giữ tỉ lệ vào khung imgsz x imgsz, phần thừa tô xám 114; trả về ảnh và (ratio, left, top)."""
+        h, w = frame.shape[:2]
+        ratio = min(self.imgsz / h, self.imgsz / w)
+        new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+        pad_x, pad_y = (self.imgsz - new_w) / 2, (self.imgsz - new_h) / 2
+        resized = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+        top, left = int(round(pad_y - 0.1)), int(round(pad_x - 0.1))
+        canvas = np.full((self.imgsz, self.imgsz, 3), 114, dtype=np.uint8)
+        canvas[top:top + new_h, left:left + new_w] = resized
+        return canvas, (ratio, left, top)
+
+    def detect(self, frames, conf_threshold=0.0):
+        images = []
+        transforms = []
+        for frame in frames:
+            image, transform = self._letterbox(frame)
+            images.append(image)
+            transforms.append(transform)
+        # BGR HWC uint8 -> RGB NCHW float32 trong [0, 1]
+        batch = np.stack(images)[..., ::-1].transpose(0, 3, 1, 2).astype(np.float32) / 255.0
+        outputs = self.session.run(None, {self.input_name: np.ascontiguousarray(batch)})[0]
+
+        detections = []
+        for frame, (ratio, left, top), output in zip(frames, transforms, outputs):
+            detections.append(self._decode(output, frame.shape[:2], ratio, left, top, conf_threshold))
+        return detections
+
+    def _decode(self, output, frame_shape, ratio, left, top, conf_threshold):
+        """Đầu ra [4 + num_classes, N] -> box person sau NMS, chuẩn hóa theo frame gốc."""
+        predictions = output.T
+        scores = predictions[:, 4:]
+        # Giống ultralytics: mỗi box thuộc class có điểm cao nhất, NMS theo từng class
+        keep = (scores.argmax(axis=1) == PERSON_CLASS) & (scores[:, PERSON_CLASS] >= max(self.conf, conf_threshold))
+        xywh = predictions[keep, :4]
+        conf = scores[keep, PERSON_CLASS]
+        if len(conf) == 0:
+            return np.zeros((0, 4), dtype=np.float32), conf
+
+        top_left = np.column_stack([xywh[:, 0] - xywh[:, 2] / 2, xywh[:, 1] - xywh[:, 3] / 2, xywh[:, 2], xywh[:, 3]])
+        indices = cv2.dnn.NMSBoxes(top_left.tolist(), conf.tolist(), 0.0, self.iou)
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        xywh, conf = xywh[indices], conf[indices]
+
+        # Bỏ letterbox, chuẩn hóa theo kích thước frame gốc
+        img_h, img_w = frame_shape
+        xywhn = np.column_stack([
+            (xywh[:, 0] - left) / ratio / img_w,
+            (xywh[:, 1] - top) / ratio / img_h,
+            xywh[:, 2] / ratio / img_w,
+            xywh[:, 3] / ratio / img_h,
+        ]).astype(np.float32)
+        return xywhn, conf
+
+
+class CascadeBackend:
+    """Model nhỏ (vd. yolov8n) chạy mọi frame, model lớn chỉ chạy lại frame khó.
+
+    Frame được chuyển lên model lớn khi model nhỏ có box person với confidence trong [low_conf, high_conf),
+    hoặc (count_change=True) khi số người model nhỏ chắc chắn (conf >= accept_conf) khác frame trước đó.
+    Các frame còn lại dùng box của model nhỏ có conf >= accept_conf.
+    """
+
+    def __init__(self, small, large, low_conf=0.1, accept_conf=0.25, high_conf=0.5, count_change=True):
+        self.small = small
+        self.large = large
+        # Model nhỏ phải trả cả box dưới ngưỡng chấp nhận để nhận ra frame không chắc chắn
+        self.small.conf = low_conf
+        self.low_conf = low_conf
+        self.accept_conf = accept_conf
+        self.high_conf = high_conf
+        self.count_change = count_change
+        self.reset()
+
+    def reset(self):
+        """Bắt đầu video mới: xóa thống kê và số người của frame trước."""
+        self.frames = 0
+        self.escalated = 0
+        self.last_count = None
+
+    def stats(self):
+        return {'frames': self.frames, 'escalated': self.escalated}
+
+    def detect(self, frames, conf_threshold=0.0):
+        detections = []
+        escalate = []
+        for i, (xywhn, conf) in enumerate(self.small.detect(frames, conf_threshold)):
+            uncertain = bool(((conf >= self.low_conf) & (conf < self.high_conf)).any())
+            accepted = conf >= self.accept_conf
+            count = int(accepted.sum())
+            changed = self.count_change and self.last_count is not None and count != self.last_count
+            self.last_count = count
+            if uncertain or changed:
+                escalate.append(i)
+                detections.append(None)
+            else:
+                detections.append((xywhn[accepted], conf[accepted]))
+
+        if escalate:
+            # Chạy model lớn một lần cho tất cả frame cần escalate trong batch
+            for i, detection in zip(escalate, self.large.detect([frames[i] for i in escalate], conf_threshold)):
+                detections[i] = detection
+        self.frames += len(frames)
+        self.escalated += len(escalate)
+        return detections
+
+
+def export_onnx(model_path, imgsz=640):
+    """Export model .pt sang ONNX (batch động) nếu chưa có; trả về đường dẫn file .onnx."""
+    onnx_path = f"{os.path.splitext(model_path)[0]}_{imgsz}.onnx"
+    if not os.path.exists(onnx_path):
+        from ultralytics import YOLO
+        exported = YOLO(model_path).export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+        os.replace(exported, onnx_path)
+    return onnx_path
+
+
+def quantize_onnx(onnx_path):
+    """Lượng tử hóa động trọng số (Conv/MatMul) sang int8 nếu chưa có; trả về đường dẫn file mới."""
+    if onnx_path.endswith("_int8.onnx"):
+        return onnx_path  # Đã là model int8 (vd. đường dẫn do prepare_model trả về)
+    quantized_path = f"{os.path.splitext(onnx_path)[0]}_int8.onnx"
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        # Ghi ra file tạm rồi mới đổi tên, không process nào load phải file đang ghi dở
+        tmp_path = f"{os.path.splitext(quantized_path)[0]}.{os.getpid()}.tmp.onnx"
+        quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QUInt8)
+        os.replace(tmp_path, quantized_path)
+    return quantized_path
+
+
+def prepare_model(model_path, backend="torch", imgsz=640):
+    """Đường dẫn file model mà backend sẽ load, export ONNX và lượng tử hóa int8 trước nếu cần.
+
+    Gọi ở process cha trước khi tạo Pool: các worker nhận thẳng file .onnx cuối cùng thay vì cùng export một file.
+    """
+    if backend not in ("onnx", "onnx-int8"):
+        return model_path
+    onnx_path = model_path if model_path.endswith(".onnx") else export_onnx(model_path, imgsz)
+    if backend == "onnx-int8":
+        onnx_path = quantize_onnx(onnx_path)
+    return onnx_path
+
+
+def load_backend(model_path="yolov8l.pt", backend="torch", imgsz=640, threads=None, cascade_model=None,
+                 cascade_low=0.1, cascade_high=0.5):
+    """Tạo backend theo tên; model_path có thể là .pt (tự export khi cần) hoặc .onnx có sẵn.
+
+    cascade_model (vd. "yolov8n.pt") bật CascadeBackend: model này chạy mọi frame bằng cùng loại backend,
+    model_path chỉ chạy lại các frame không chắc chắn.
+    """
+    if cascade_model:
+        small = load_backend(cascade_model, backend, imgsz, threads)
+        large = load_backend(model_path, backend, imgsz, threads)
+        return CascadeBackend(small, large, low_conf=cascade_low, high_conf=cascade_high)
+    if backend == "torch":
+        return UltralyticsBackend(model_path, imgsz, threads)
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxRuntimeBackend(prepare_model(model_path, backend, imgsz), imgsz, threads)
+    raise ValueError(f"Unknown backend: {backend}")
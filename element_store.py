@@ -0,0 +1,310 @@
+"""Indexed store of element rows (color / action / gender per person per frame), shared by
+label_tool, prompt_gen and expression.
+
+Rows live in a SQLite database (WAL mode, so the labeling tool can write while the generators read)
+keyed by (video, frame_id, class_id), where video is the N of elements_N.csv. The CSV files stay the
+interchange format: open_store() re-imports a CSV whenever it changed on disk since it was last synced,
+and export_csv() writes a video back out.
+"""
+import csv
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+
+ELEMENT_COLUMNS = ['frame_id', 'class_id', 'color', 'action', 'gender']
+STORE_NAME = "elements.sqlite"
+CSV_PATTERN = re.compile(r"elements_(\w+)\.csv")
+
+
+def video_key(csv_path):
+    """'0' for .../elements_0.csv; None if the file isn't an elements CSV."""
+    match = CSV_PATTERN.fullmatch(os.path.basename(csv_path))
+    return match.group(1) if match else None
+
+
+def elements_csv(elements_folder, video):
+    return os.path.join(elements_folder, f"elements_{video}.csv")
+
+
+def read_rows(csv_path, store=None):
+    """Element rows of one elements CSV: from the store when one is given, else straight from the file.
+
+    Both give the rows in CSV order, so readers that keep the last row per class see the same row either way.
+    """
+    if store is not None:
+        return store.all_rows(video_key(csv_path))
+    with open(csv_path, mode='r', newline='') as file:
+        return [row for row in csv.DictReader(file) if row.get('frame_id') and row.get('class_id')]
+
+
+class ElementStore:
+    """Element rows of every video in one indexed table; all reads return dicts with ELEMENT_COLUMNS keys."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS elements ("
+            "video TEXT, frame_id INTEGER, class_id INTEGER, color TEXT, action TEXT, gender TEXT, "
+            "PRIMARY KEY (video, frame_id, class_id))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS elements_class ON elements (video, class_id, frame_id)")
+        # CSV size and mtime at the last import or export, to tell when a CSV was edited outside the store
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sources (video TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)")
+        self.conn.commit()
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def range(self, video, start=None, end=None, class_id=None):
+        """Rows with start <= frame_id < end (open-ended when None), ordered by frame then class."""
+        conditions = ["video = ?"]
+        params = [video]
+        if start is not None:
+            conditions.append("frame_id >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("frame_id < ?")
+            params.append(end)
+        if class_id is not None:
+            conditions.append("class_id = ?")
+            params.append(class_id)
+        return self._query(
+            f"SELECT {', '.join(ELEMENT_COLUMNS)} FROM elements WHERE {' AND '.join(conditions)} "
+            "ORDER BY frame_id, class_id", params)
+
+    def all_rows(self, video):
+        """Every row of a video in insertion order, the order the CSV had when it was imported."""
+        return self._query(
+            f"SELECT {', '.join(ELEMENT_COLUMNS)} FROM elements WHERE video = ? ORDER BY rowid", (video,))
+
+    def upsert(self, video, rows):
+        """Insert or update many rows in one transaction; missing columns are stored as ''."""
+        values = [
+            (video, int(row['frame_id']), int(row['class_id']),
+             row.get('color') or '', row.get('action') or '', row.get('gender') or '')
+            for row in rows
+        ]
+        with self.lock:
+            # ON CONFLICT keeps the rowid, so an updated row keeps its position like it did in the CSV
+            self.conn.executemany(
+                "INSERT INTO elements VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (video, frame_id, class_id) "
+                "DO UPDATE SET color = excluded.color, action = excluded.action, gender = excluded.gender",
+                values)
+            self.conn.commit()
+
+    def delete(self, video, start=None, end=None):
+        """Delete the rows with start <= frame_id < end (open-ended when None)."""
+        conditions = ["video = ?"]
+        params = [video]
+        if start is not None:
+            conditions.append("frame_id >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("frame_id < ?")
+            params.append(end)
+        with self.lock:
+            self.conn.execute(f"DELETE FROM elements WHERE {' AND '.join(conditions)}", params)
+            self.conn.commit()
+
+    def delete_rows(self, video, keys):
+        """Delete the rows with the given (frame_id, class_id) keys in one transaction."""
+        with self.lock:
+            self.conn.executemany("DELETE FROM elements WHERE video = ? AND frame_id = ? AND class_id = ?",
+                                  [(video, frame_id, class_id) for frame_id, class_id in keys])
+            self.conn.commit()
+
+    def content_hash(self, video):
+        """SHA-1 of a video's rows, for change tracking without a CSV export."""
+        digest = hashlib.sha1()
+        for row in self.range(video):
+            digest.update(repr([row[column] for column in ELEMENT_COLUMNS]).encode('utf-8'))
+        return digest.hexdigest()
+
+    def import_csv(self, video, csv_path):
+        """Replace a video's rows with the content of its CSV (rows without ids are skipped)."""
+        rows = read_rows(csv_path)
+        self.delete(video)
+        self.upsert(video, rows)
+        self._mark_synced(video, csv_path)
+
+    def export_csv(self, video, csv_path):
+        """Write a video's rows to its CSV in insertion order, the order the CSV had when it was imported."""
+        rows = self.all_rows(video)
+        tmp_path = f"{csv_path}.tmp"
+        with open(tmp_path, mode='w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=ELEMENT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, csv_path)
+        self._mark_synced(video, csv_path)
+
+    def _mark_synced(self, video, csv_path):
+        stat = os.stat(csv_path)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (video, stat.st_size, stat.st_mtime_ns))
+            self.conn.commit()
+
+    def sync_csv(self, video, csv_path):
+        """Import the CSV if it changed on disk since the last import or export; returns True if it did."""
+        if not os.path.exists(csv_path):
+            return False
+        stat = os.stat(csv_path)
+        synced = self._query("SELECT size, mtime_ns FROM sources WHERE video = ?", (video,))
+        if synced and (synced[0]['size'], synced[0]['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            return False
+        self.import_csv(video, csv_path)
+        return True
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ElementModel:
+    """Elements of one video held in memory for label_tool, keyed by (frame_id, class_id).
+
+    Rows are loaded from the store once. Changes only mark rows dirty and are appended to a JSON Lines
+    journal; flush() writes the dirty rows to the store in one batch and empties the journal. A journal
+    left behind by a crash is replayed into the store when the model is opened again.
+    """
+
+    def __init__(self, store, video, journal_path):
+        self.store = store
+        self.video = video
+        self.journal_path = journal_path
+        self.recover()
+        self.rows = {}  # (frame_id, class_id) -> row, in insertion order
+        self.frames = {}  # frame_id -> {class_id: row}
+        self.first = {}  # class_id -> the class's first row, used for frames without their own row
+        self.last_frame = -1
+        for row in store.all_rows(video):
+            self._add(row)
+        # Keys upserted since the last flush, in the order they were first changed: a dict rather than a set so new
+        # rows reach the store (and get their rowids, i.e. their CSV position) in the order they were made
+        self.dirty = {}
+        self.deleted = set()  # Keys deleted since the last flush
+        self.journal = None
+
+    def _add(self, row):
+        key = (row['frame_id'], row['class_id'])
+        self.rows[key] = row
+        self.frames.setdefault(row['frame_id'], {})[row['class_id']] = row
+        self.first.setdefault(row['class_id'], row)
+        self.last_frame = max(self.last_frame, row['frame_id'])
+
+    def frame(self, frame_id):
+        """{class_id: row} of one frame."""
+        return self.frames.get(frame_id, {})
+
+    def first_per_class(self):
+        return self.first
+
+    def set_rows(self, rows):
+        """Insert or update rows; returns True if anything actually changed."""
+        changed = []
+        for row in rows:
+            row = {'frame_id': int(row['frame_id']), 'class_id': int(row['class_id']),
+                   'color': row.get('color') or '', 'action': row.get('action') or '', 'gender': row.get('gender') or ''}
+            key = (row['frame_id'], row['class_id'])
+            current = self.rows.get(key)
+            if current == row:
+                continue
+            if current is None:
+                self._add(row)
+            else:
+                current.update(row)  # In place, so self.frames and self.first see the change
+            self.deleted.discard(key)
+            self.dirty[key] = None
+            changed.append({'op': 'upsert', 'row': row})
+        self._log(changed)
+        return bool(changed)
+
+    def delete_from(self, frame_id):
+        """Delete every row with a frame id >= frame_id; returns True if any existed."""
+        if frame_id > self.last_frame:
+            return False  # The usual case on every save, without scanning the rows
+        keys = [key for key in self.rows if key[0] >= frame_id]
+        for key in keys:
+            row = self.rows.pop(key)
+            frame_rows = self.frames[key[0]]
+            del frame_rows[key[1]]
+            if not frame_rows:
+                del self.frames[key[0]]
+            if self.first.get(key[1]) is row:
+                # Fall back to the class's next row in insertion order, if it has one left
+                del self.first[key[1]]
+                for other in self.rows.values():
+                    if other['class_id'] == key[1]:
+                        self.first[key[1]] = other
+                        break
+            self.dirty.pop(key, None)
+            self.deleted.add(key)
+        self.last_frame = max(self.frames, default=-1)
+        self._log([{'op': 'delete', 'key': list(key)} for key in keys])
+        return bool(keys)
+
+    def _log(self, entries):
+        if not entries:
+            return
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'a')
+        for entry in entries:
+            self.journal.write(json.dumps(entry) + "\n")
+        self.journal.flush()
+
+    def flush(self):
+        """Write the dirty rows to the store in one batch and empty the journal."""
+        if self.deleted:
+            self.store.delete_rows(self.video, self.deleted)
+        if self.dirty:
+            self.store.upsert(self.video, [self.rows[key] for key in self.dirty])
+        self.dirty = {}
+        self.deleted = set()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def recover(self):
+        """Replay a journal left by a run that didn't flush into the store; returns the number of changes."""
+        if not os.path.exists(self.journal_path):
+            return 0
+        upserts = {}
+        count = 0
+        with open(self.journal_path, 'r') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # Torn last line from the crash
+                count += 1
+                if entry['op'] == 'upsert':
+                    row = entry['row']
+                    upserts[(row['frame_id'], row['class_id'])] = row
+                else:
+                    key = tuple(entry['key'])
+                    upserts.pop(key, None)
+                    self.store.delete_rows(self.video, [key])
+        self.store.upsert(self.video, upserts.values())
+        os.remove(self.journal_path)
+        return count
+
+
+def open_store(elements_folder, sync=True):
+    """The store of an elements folder; with sync, every elements_N.csv edited outside the store is re-imported."""
+    store = ElementStore(os.path.join(elements_folder, STORE_NAME))
+    if sync:
+        for file in sorted(os.listdir(elements_folder)):
+            video = video_key(file)
+            if video is not None:
+                store.sync_csv(video, os.path.join(elements_folder, file))
+    return store
@@ -1,57 +1,234 @@
 import os
 import json
-import csv
-import openai
+import hashlib
 import re
-from prompt_gen import generate_prompts
+import shutil
+from multiprocessing import Pool
+from prompt_gen import iter_prompts, prompt_file_for, write_prompt_file
+from attribute_matcher import AttributeMatcher
+from paraphrasers import load_paraphraser
+from paraphrase_cache import ParaphraseCache, normalize_sentence
+from expression_shards import sanitize_filename, write_shard
+from element_store import open_store, video_key
 # Configuration
 # openai.api_key = "api ne "  # Replace with your OpenAI API key
 prompts_output_folder = "prompt_gen"  # Replace with the actual path
 labels_folder = "labels_with_ids"  # Replace with the actual path
 elements_folder = "elements"  # Replace with the actual path
 output_folder = "expression"  # Replace with the actual path
+label_index_path = os.path.join(labels_folder, "label_index.json")  # Set to None to keep the index in memory only
+# "json": one indented file per paraphrase; "jsonl": compact labels.jsonl/expressions.jsonl shard per subfolder
+# (expression_shards.py rebuilds the per-file layout from a shard)
+output_format = "json"
+video_workers = None  # Videos processed in parallel, one process each; None uses every CPU core
+# Records which inputs each video's outputs were built from, so reruns only rebuild videos whose inputs changed
+manifest_name = "expression_manifest.json"
+force_regenerate = False  # Rebuild every video even if its inputs are unchanged
+# Paraphrase backend: "openai" (chat-completion API) or "local" (offline, see paraphrasers.py)
+paraphraser = "openai"
+local_paraphrase_options = {"seed": 0}
+# Paraphrase API settings: concurrent requests, rate limits, retries and timeout (see ParaphraseClient)
+paraphrase_options = {
+    "model": "gpt-3.5-turbo",
+    "temperature": 0.7,
+    "concurrency": 8,
+    "requests_per_minute": 3500,
+    "tokens_per_minute": 90000,
+    "max_retries": 5,
+    "timeout": 30,
+    "api_base": None,  # e.g. "http://127.0.0.1:8000/v1" for a local stub server
+}
+paraphrase_cache_path = "paraphrase_cache.sqlite"  # Set to None to always call the API
+paraphrase_cache_mb = 64  # Least recently used entries are evicted past this size
+num_paraphrases = 5  # Paraphrased sentences (JSON files) wanted per raw sentence
+min_paraphrases = 1  # Fewer than this after max_paraphrase_attempts API calls is reported as a failure
+max_paraphrase_attempts = 3  # API calls per raw sentence; each asks for all the paraphrases still missing
 
 def main():
-    # Generate prompts using generate_prompts function
-    prompt_file_paths = generate_prompts(elements_folder, prompts_output_folder)
-
-    # Process each generated prompt file
-    for i, prompt_file_path in enumerate(prompt_file_paths):
-        # Determine the subfolder name for each elements file
-        subfolder_name = f"{i:04d}"
-        subfolder_path = os.path.join(output_folder, subfolder_name)
-        os.makedirs(subfolder_path, exist_ok=True)
-
-        # Read raw sentences from the generated prompt file
-        with open(prompt_file_path, 'r') as file:
-            raw_sentences = [line.strip() for line in file.readlines()]
-
-        # Parse elements from CSV files
-        element_data = parse_elements(elements_folder)
-
-        # Process each raw sentence
-        for raw_sentence in raw_sentences:
-            matching_ids = find_matching_ids(raw_sentence, element_data)
-            frame_data = filter_frames(labels_folder, matching_ids)
-            generate_json_files(raw_sentence, frame_data, subfolder_path)
-
-def parse_elements(elements_folder):
-    """Parse the elements CSV files to collect the data."""
-    element_data = {}
-    for file in os.listdir(elements_folder):
-        if file.endswith(".csv"):
-            file_path = os.path.join(elements_folder, file)
-            with open(file_path, mode='r') as csv_file:
-                reader = csv.DictReader(csv_file)
-                for row in reader:
-                    element_data[int(row['class_id'])] = {
-                        'color': row['color'].strip().lower() if row['color'] else '',  # Convert to lowercase
-                        'action': row['action'].strip().lower() if row['action'] else ''  # Convert to lowercase
-                    }
-    return element_data
+    # Scan the label files once for the whole run instead of once per sentence
+    label_index = build_label_index(labels_folder, label_index_path)
+
+    # Run settings that change the outputs; a change rebuilds every video
+    params = {
+        'output_format': output_format,
+        'paraphraser': paraphraser,
+        'num_paraphrases': num_paraphrases,
+    }
+    if paraphraser == "local":
+        params.update(local_paraphrase_options)
+    else:
+        params.update({'model': paraphrase_options.get('model'), 'temperature': paraphrase_options.get('temperature')})
+    os.makedirs(output_folder, exist_ok=True)
+    manifest_path = os.path.join(output_folder, manifest_name)
+    manifest = read_json(manifest_path, {'videos': {}})
+    entries = manifest['videos']
+
+    # Each elements_N.csv only describes labels_with_ids/N, so every video is an independent job
+    pending = []
+    pairs = pair_videos(elements_folder, label_index)
+    # Elements are read from the shared store; CSVs edited outside label_tool are re-imported first
+    store = open_store(elements_folder)
+    for video_name, elements_path in pairs:
+        subfolder_path = os.path.join(output_folder, video_name)
+        inputs = {
+            'elements': os.path.basename(elements_path),
+            'elements_hash': store.content_hash(video_key(elements_path)),
+            'labels_hash': labels_hash(label_index[video_name]),
+        }
+        entry = entries.get(video_name)
+        if not force_regenerate and entry and entry.get('done') and entry['inputs'] == inputs \
+                and entry['params'] == params and all(os.path.exists(path) for path in entry['outputs']):
+            print(f"Skipped (up to date): {video_name}")
+            continue
+        # Paraphrases name the output files, so old files would linger next to the new ones
+        _remove_outputs(entry)
+        prompt_file_path = prompt_file_for(elements_path, prompts_output_folder)
+        entries[video_name] = {'inputs': inputs, 'params': params, 'outputs': [subfolder_path, prompt_file_path],
+                               'done': False}
+        prompts = list(iter_prompts(elements_path, store))
+        pending.append((video_name, elements_path, label_index[video_name], subfolder_path, prompts))
+
+    store.close()
+
+    # Outputs of videos whose elements CSV or label folder is gone
+    for video_name in set(entries) - {video_name for video_name, _ in pairs}:
+        print(f"Removing orphaned outputs: {video_name}")
+        _remove_outputs(entries.pop(video_name))
+    write_json_atomic(manifest_path, manifest)
+    if not pending:
+        return
+
+    # Templates only depend on the attributes, so videos share many raw sentences: each distinct one is
+    # paraphrased once per run, here, before the videos are dispatched
+    paraphrases = paraphrase_all(list(dict.fromkeys(
+        prompt.strip() for _, _, _, _, prompts in pending for prompt, _ in prompts)))
+    jobs = [
+        job + ({prompt.strip(): paraphrases[prompt.strip()] for prompt, _ in job[4]},)
+        for job in pending
+    ]
+
+    def completed(result):
+        _print_video_completed(result)
+        entries[result[0]]['done'] = True
+        write_json_atomic(manifest_path, manifest)
+
+    workers = max(1, min(video_workers or os.cpu_count() or 1, len(jobs)))
+    if workers == 1:
+        for job in jobs:
+            completed(process_video(job))
+    else:
+        with Pool(workers) as pool:
+            for result in pool.imap_unordered(process_video, jobs):
+                completed(result)
+
+def paraphrase_all(raw_sentences):
+    """{raw sentence: paraphrases} of distinct raw sentences, paraphrased concurrently with the configured backend."""
+    cache = None
+    if paraphraser == "local":
+        client = load_paraphraser(paraphraser, **local_paraphrase_options)
+    else:
+        # Only the API backend is worth caching; the local one is faster than a cache lookup
+        if paraphrase_cache_path:
+            cache = ParaphraseCache(paraphrase_cache_path, paraphrase_cache_mb * 1024 * 1024)
+        client = load_paraphraser(paraphraser, cache, **paraphrase_options)
+    try:
+        # The client bounds in-flight requests and rate limits them
+        results = client.map(lambda raw_sentence: collect_paraphrases(raw_sentence, client), raw_sentences)
+    finally:
+        if cache is not None:
+            cache.close()
+    return dict(zip(raw_sentences, results))
+
+def labels_hash(id_frames):
+    """SHA-1 of one video's class ID -> frames index; unchanged labels hash the same even if their files were touched."""
+    canonical = json.dumps({str(cls_id): sorted(frames) for cls_id, frames in sorted(id_frames.items())})
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+def read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def write_json_atomic(path, data):
+    """Write JSON through a temporary file and os.replace so an interrupted run never leaves a broken file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+def _remove_outputs(entry):
+    """Delete the output folder and prompt file recorded in a manifest entry."""
+    for path in (entry or {}).get('outputs', []):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+def pair_videos(elements_folder, label_index):
+    """Sorted (label folder, elements CSV) pairs: elements_N.csv goes with the label folder whose number is N."""
+    videos = {}
+    for video_name in label_index:
+        if video_name.isdigit():
+            videos[int(video_name)] = video_name
+    pairs = []
+    for file in sorted(os.listdir(elements_folder)):
+        match = re.fullmatch(r"elements_(\d+)\.csv", file)
+        if not match:
+            continue
+        video_name = videos.get(int(match.group(1)))
+        if video_name is None:
+            print(f"No label folder for {file}, skipping")
+            continue
+        pairs.append((video_name, os.path.join(elements_folder, file)))
+    return pairs
+
+def process_video(job):
+    """Generate the expressions of one video from its own elements CSV and labels; returns (video, sentence count).
+
+    The job carries the video's prompts (prompt_gen.iter_prompts) and {raw sentence: paraphrases} for its distinct
+    raw sentences, which main() paraphrases once for the whole run.
+    """
+    video_name, elements_path, id_frames, subfolder_path, prompts, paraphrases = job
+    os.makedirs(subfolder_path, exist_ok=True)
+
+    # This video's prompts, one per attribute span (a class in one color/action state and its frames)
+    write_prompt_file(elements_path, prompts_output_folder, [prompt for prompt, _ in prompts])
+    spans = [span for _, span in prompts]
+    coverage = state_ranges(spans)
+    # Sentences are matched against each span rather than one attribute set per class, so a class that changes
+    # color or action only contributes the frames of its matching state
+    matcher = AttributeMatcher({
+        index: {'color': span['color'].strip().lower(), 'action': span['action'].strip().lower()}
+        for index, span in enumerate(spans)
+    })
+    video_index = {video_name: id_frames}
+
+    # Identical sentences would produce identical files, so each one is generated once
+    results = []
+    for raw_sentence in paraphrases:
+        ranges = {}
+        for index in matcher.match(raw_sentence):
+            ranges.setdefault(spans[index]['class_id'], []).extend(coverage[index])
+        frame_data = filter_frames(video_index, ranges, ranges)
+        results.append((raw_sentence, frame_data, paraphrases[raw_sentence]))
+    if output_format == "jsonl":
+        write_shard(subfolder_path, video_name, results)
+    else:
+        for raw_sentence, frame_data, sentences in results:
+            generate_json_files(raw_sentence, frame_data, sentences, subfolder_path, video_name)
+    return video_name, len(results)
+
+def _print_video_completed(result):
+    video_name, count = result
+    print(f"Completed {video_name}: {count} sentences")
 
 def find_matching_ids(prompt, element_data):
-    """Find IDs that match the given prompt based on the element data."""
+    """Find IDs that match the given prompt based on the element data.
+
+    Plain substring scan over every class; main() uses AttributeMatcher instead, this is kept as the reference
+    implementation for bench_matcher.py.
+    """
     prompt_lower = prompt.lower()  # Convert the prompt to lowercase for case-insensitive matching
     matching_ids = []
     for cls_id, attributes in element_data.items():
@@ -62,83 +239,152 @@ def find_matching_ids(prompt, element_data):
             matching_ids.append(cls_id)
     return matching_ids
 
-def filter_frames(labels_folder, matching_ids):
-    """Filter frames to find all IDs matching the attributes."""
-    frame_data = {}
+def _video_signature(video_path):
+    """Number of label files and newest mtime in a video folder; changes whenever a label is added, removed or edited."""
+    count = 0
+    newest = 0
+    for entry in os.scandir(video_path):
+        if entry.name.endswith(".txt"):
+            count += 1
+            newest = max(newest, entry.stat().st_mtime_ns)
+    return [count, newest]
+
+def _index_video(video_path):
+    """Read every label file of one video into {class_id: sorted frame numbers}."""
+    id_frames = {}
+    for file in os.listdir(video_path):
+        if file.endswith(".txt"):
+            frame_number = int(file.split('.')[0])  # Assuming filename is like "000001.txt"
+            with open(os.path.join(video_path, file), 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) > 1:
+                        id_frames.setdefault(int(parts[1]), set()).add(frame_number)
+    return {cls_id: sorted(frames) for cls_id, frames in id_frames.items()}
+
+def build_label_index(labels_folder, index_path=None):
+    """Build a video -> class ID -> frame numbers index of labels_folder in one pass.
+
+    If index_path is given, the index is loaded from and saved to that JSON file; a video is only
+    rescanned when its signature (label file count and newest mtime) differs from the stored one.
+    """
+    stored = {}
+    if index_path and os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            stored = json.load(f)
+
+    label_index = {}
+    changed = False
     for subfolder in os.listdir(labels_folder):
         subfolder_path = os.path.join(labels_folder, subfolder)
-        if os.path.isdir(subfolder_path):
-            for file in os.listdir(subfolder_path):
-                if file.endswith(".txt"):
-                    frame_number = int(file.split('.')[0])  # Assuming filename is like "000001.txt"
-                    file_path = os.path.join(subfolder_path, file)
-
-                    with open(file_path, 'r') as f:
-                        lines = f.readlines()
-                        frame_ids = []
-                        for line in lines:
-                            parts = line.strip().split()
-                            id_in_frame = int(parts[1])
-                            if id_in_frame in matching_ids:
-                                frame_ids.append(id_in_frame)
-
-                        if frame_ids:
-                            frame_data[frame_number] = sorted(frame_ids)
+        if not os.path.isdir(subfolder_path):
+            continue
+        signature = _video_signature(subfolder_path)
+        cached = stored.get(subfolder)
+        if cached and cached['signature'] == signature:
+            id_frames = {int(cls_id): frames for cls_id, frames in cached['ids'].items()}
+        else:
+            id_frames = _index_video(subfolder_path)
+            changed = True
+        stored[subfolder] = {'signature': signature, 'ids': id_frames}
+        label_index[subfolder] = {cls_id: set(frames) for cls_id, frames in id_frames.items()}
+
+    if index_path and (changed or set(stored) != set(label_index)):
+        # Drop videos that no longer exist before saving
+        stored = {video: stored[video] for video in label_index}
+        with open(index_path, 'w') as f:
+            json.dump(stored, f)
+    return label_index
+
+def state_ranges(spans):
+    """Frames each prompt_gen attribute span's state holds for, as one [(start, end), ...] list per span.
+
+    Attributes are only entered on some frames and carry over to the following ones: each annotated run of a span
+    covers the frames up to the next run of the same class. The first run of a class also covers the frames before
+    it and the last one every frame after it; None stands for such an open end. Ends are included.
+    """
+    runs = {}
+    for index, span in enumerate(spans):
+        for start, _ in span['ranges']:
+            runs.setdefault(span['class_id'], []).append((start, index))
+    coverage = [[] for _ in spans]
+    for class_runs in runs.values():
+        class_runs.sort()
+        for position, (start, index) in enumerate(class_runs):
+            first = start if position > 0 else None
+            last = class_runs[position + 1][0] - 1 if position + 1 < len(class_runs) else None
+            coverage[index].append((first, last))
+    return coverage
+
+def _in_ranges(frame_number, ranges):
+    return any((start is None or start <= frame_number) and (end is None or frame_number <= end)
+               for start, end in ranges)
+
+def filter_frames(label_index, matching_ids, ranges=None):
+    """Filter frames to find all IDs matching the attributes.
+
+    ranges ({class_id: [(start, end), ...]}, see state_ranges) limits each class to the frames where it is in the
+    matching state; without it every labeled frame of a matching class is kept.
+    """
+    matching_ids = set(matching_ids)
+    frame_data = {}
+    for id_frames in label_index.values():
+        # Only the matching IDs that actually appear in this video are looked up
+        video_frames = {}
+        for cls_id in matching_ids.intersection(id_frames):
+            for frame_number in id_frames[cls_id]:
+                if ranges is not None and not _in_ranges(frame_number, ranges[cls_id]):
+                    continue
+                video_frames.setdefault(frame_number, []).append(cls_id)
+        for frame_number, frame_ids in video_frames.items():
+            frame_data[frame_number] = sorted(frame_ids)
     return frame_data
 
-def generate_json_files(raw_sentence, frame_data, subfolder_path):
+def collect_paraphrases(raw_sentence, client):
+    """Up to num_paraphrases distinct paraphrases, using at most max_paraphrase_attempts API calls."""
+    seen = {normalize_sentence(raw_sentence)}
+    sentences = []
+
+    def take(candidates):
+        for candidate in candidates:
+            key = normalize_sentence(candidate)
+            if key not in seen:
+                seen.add(key)
+                sentences.append(candidate)
+
+    # Paraphrases cached by earlier runs are used first; the API is only asked for the rest
+    take(client.cached(raw_sentence))
+    attempts = 0
+    while len(sentences) < num_paraphrases and attempts < max_paraphrase_attempts:
+        take(client.paraphrase(raw_sentence, num_paraphrases - len(sentences)))
+        attempts += 1
+
+    if len(sentences) < min_paraphrases:
+        print(f"Only {len(sentences)} paraphrases after {attempts} attempts: {raw_sentence}")
+        if not sentences:
+            sentences.append(raw_sentence)  # Fall back to the original sentence so it still gets a file
+    return sentences[:num_paraphrases]
+
+def generate_json_files(raw_sentence, frame_data, sentences, subfolder_path, video_name):
     """Generate JSON files with paraphrased sentences."""
-    generated_sentences = set()  # Store sentences to avoid repetition
-    counter = 0
-
-    while len(generated_sentences) < 5:
-        paraphrased_sentence = paraphrase(raw_sentence)
-        if paraphrased_sentence not in generated_sentences:
-            generated_sentences.add(paraphrased_sentence)
-            
-            # Prepare JSON data
-            json_data = {
-                "label": frame_data,
-                "ignore": [],
-                "video_name": os.path.basename(labels_folder),
-                "sentence": paraphrased_sentence,
-                "raw_sentence": raw_sentence
-            }
-
-            # Sanitize filename by removing invalid characters
-            sanitized_prompt = sanitize_filename(paraphrased_sentence)
-
-            # Save JSON file
-            json_filename = f"{sanitized_prompt}.json"
-            json_path = os.path.join(subfolder_path, json_filename)
-            with open(json_path, 'w') as json_file:
-                json.dump(json_data, json_file, indent=4)
-            counter += 1
-
-def paraphrase(sentence):
-    """Use OpenAI API to paraphrase the sentence."""
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that paraphrases sentences."},
-                {"role": "user", "content": f"Paraphrase the following sentence: '{sentence}'"}
-            ],
-            max_tokens=60,
-            temperature=0.7,
-        )
-        paraphrased_sentence = response['choices'][0]['message']['content'].strip()
-        return paraphrased_sentence
-    except Exception as e:
-        print(f"Error during paraphrasing: {e}")
-        return sentence  # Return the original sentence if paraphrasing fails
-
-def sanitize_filename(prompt):
-    """Sanitize the prompt to create a valid filename."""
-    sanitized_prompt = re.sub(r'[<>:"/\\|?*\n]', '', prompt)  # Remove invalid characters
-    sanitized_prompt = sanitized_prompt.replace(' ', '_')  # Replace spaces with underscores
-    sanitized_prompt = sanitized_prompt[:150]  # Optionally truncate to prevent overly long filenames
-    return sanitized_prompt
+    for paraphrased_sentence in sentences:
+        # Prepare JSON data
+        json_data = {
+            "label": frame_data,
+            "ignore": [],
+            "video_name": video_name,
+            "sentence": paraphrased_sentence,
+            "raw_sentence": raw_sentence
+        }
+
+        # Sanitize filename by removing invalid characters
+        sanitized_prompt = sanitize_filename(paraphrased_sentence)
+
+        # Save JSON file
+        json_filename = f"{sanitized_prompt}.json"
+        json_path = os.path.join(subfolder_path, json_filename)
+        with open(json_path, 'w') as json_file:
+            json.dump(json_data, json_file, indent=4)
 
 if __name__ == "__main__":
     main()
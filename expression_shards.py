@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import re
+
+LABELS_NAME = "labels.jsonl"  # One line per raw sentence: {"id", "raw_sentence", "video_name", "label"}
+EXPRESSIONS_NAME = "expressions.jsonl"  # One line per paraphrase: {"label_id", "sentence"}
+
+
+def _dump(record):
+    return json.dumps(record, separators=(',', ':'), ensure_ascii=False)
+
+
+def write_shard(shard_path, video_name, results):
+    """Write one video's expressions as compact JSON Lines; the frame map is stored once per raw sentence.
+
+    results is a list of (raw_sentence, frame_data, sentences) as produced by expression.main.
+    """
+    os.makedirs(shard_path, exist_ok=True)
+    labels_tmp = os.path.join(shard_path, LABELS_NAME + ".tmp")
+    expressions_tmp = os.path.join(shard_path, EXPRESSIONS_NAME + ".tmp")
+    with open(labels_tmp, 'w', encoding='utf-8') as labels_file, \
+            open(expressions_tmp, 'w', encoding='utf-8') as expressions_file:
+        for label_id, (raw_sentence, frame_data, sentences) in enumerate(results):
+            labels_file.write(_dump({
+                "id": label_id,
+                "raw_sentence": raw_sentence,
+                "video_name": video_name,
+                "label": frame_data,
+            }) + "\n")
+            for sentence in sentences:
+                expressions_file.write(_dump({"label_id": label_id, "sentence": sentence}) + "\n")
+    # Replace both files only once they are complete so a crash never leaves a half-written shard
+    os.replace(labels_tmp, os.path.join(shard_path, LABELS_NAME))
+    os.replace(expressions_tmp, os.path.join(shard_path, EXPRESSIONS_NAME))
+
+
+def read_shard(shard_path):
+    """Yield each expression in the per-file JSON layout (label, ignore, video_name, sentence, raw_sentence)."""
+    labels = {}
+    with open(os.path.join(shard_path, LABELS_NAME), encoding='utf-8') as labels_file:
+        for line in labels_file:
+            record = json.loads(line)
+            labels[record["id"]] = record
+    with open(os.path.join(shard_path, EXPRESSIONS_NAME), encoding='utf-8') as expressions_file:
+        for line in expressions_file:
+            expression = json.loads(line)
+            label = labels[expression["label_id"]]
+            yield {
+                "label": label["label"],
+                "ignore": [],
+                "video_name": label["video_name"],
+                "sentence": expression["sentence"],
+                "raw_sentence": label["raw_sentence"],
+            }
+
+
+def sanitize_filename(prompt):
+    """Sanitize the prompt to create a valid filename."""
+    sanitized_prompt = re.sub(r'[<>:"/\\|?*\n]', '', prompt)  # Remove invalid characters
+    sanitized_prompt = sanitized_prompt.replace(' ', '_')  # Replace spaces with underscores
+    sanitized_prompt = sanitized_prompt[:150]  # Optionally truncate to prevent overly long filenames
+    return sanitized_prompt
+
+
+def expand_shard(shard_path, output_path):
+    """Rebuild the one-indented-file-per-paraphrase layout of a shard; returns the number of files written."""
+    os.makedirs(output_path, exist_ok=True)
+    count = 0
+    for json_data in read_shard(shard_path):
+        json_path = os.path.join(output_path, f"{sanitize_filename(json_data['sentence'])}.json")
+        with open(json_path, 'w') as json_file:
+            json.dump(json_data, json_file, indent=4)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild per-file expression JSON from JSON Lines shards")
+    parser.add_argument("shards", help="Folder of shards, e.g. expression (one subfolder per video)")
+    parser.add_argument("output", help="Folder for the rebuilt per-file layout")
+    args = parser.parse_args()
+
+    for name in sorted(os.listdir(args.shards)):
+        shard_path = os.path.join(args.shards, name)
+        if os.path.isfile(os.path.join(shard_path, LABELS_NAME)):
+            count = expand_shard(shard_path, os.path.join(args.output, name))
+            print(f"{name}: {count} files")
+
+
+if __name__ == "__main__":
+    main()
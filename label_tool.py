@@ -4,6 +4,90 @@ from PIL import Image, ImageTk
 import os
 from pathlib import Path
 import csv
+import json
+import threading
+from collections import OrderedDict
+from element_store import ElementModel, open_store
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')  # Frame formats written by pre_label_tool
+
+def load_resized(frame_path, resize_factor):
+    """Open and decode a frame, resized by resize_factor (no resize if it is 1)."""
+    image = Image.open(frame_path)
+    if resize_factor != 1.0:
+        new_w = int(image.width * resize_factor)
+        new_h = int(image.height * resize_factor)
+        return image.resize((new_w, new_h), Image.LANCZOS)
+    image.load()  # Decode now, not lazily on the UI thread
+    return image
+
+class FrameCache:
+    """LRU cache of resized frames keyed by (frame path, resize factor), bounded by decoded size in MB."""
+    def __init__(self, max_mb=512):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.images = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()  # Shared by the UI thread and the prefetch thread
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.images
+
+    def get(self, key):
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        nbytes = image.width * image.height * len(image.getbands())
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.images:
+                return
+            self.images[key] = image
+            self.size += nbytes
+            # Evict least recently used frames until the cache fits again
+            while self.size > self.max_bytes:
+                _, old = self.images.popitem(last=False)
+                self.size -= old.width * old.height * len(old.getbands())
+
+    def discard(self, frame_path):
+        """Drop every cached size of a frame (e.g. after the frame file was deleted)."""
+        with self.lock:
+            for key in [key for key in self.images if key[0] == frame_path]:
+                old = self.images.pop(key)
+                self.size -= old.width * old.height * len(old.getbands())
+
+class FramePrefetcher:
+    """Background thread that decodes and resizes upcoming frames into a FrameCache."""
+    def __init__(self, cache):
+        self.cache = cache
+        self.pending = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def request(self, keys):
+        """Replace the pending work with keys (nearest first); frames already cached are skipped."""
+        with self.condition:
+            self.pending = list(keys)
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                key = self.pending.pop(0)
+            if key in self.cache:
+                continue
+            try:
+                self.cache.put(key, load_resized(*key))
+            except OSError:
+                pass  # Frame deleted or unreadable; load_frame reports it if it is ever shown
 
 class LabelTool:
     def __init__(self, root):
@@ -12,11 +96,23 @@ class LabelTool:
         self.output_folder = ""
         self.elements_folder = ""  # Folder path for elements
         self.elements_file = ""  # Full path to elements CSV file
+        self.element_store = None  # Indexed element rows of every video; the CSV is written back on close
+        self.video = ""  # Video key of the elements file (the N of elements_N.csv)
+        self.elements = None  # In-memory elements of the opened video; changes reach the store on flush
+        self.flush_job = None
+        self.flush_delay_ms = 2000  # Dirty elements are flushed once the tool has been idle this long
         self.frames = []
         self.current_frame_index = 0
         self.bboxes = []
         self.current_bbox = None
         self.scale_factor = 0.5  # Scale factor for image resizing
+        self.stored_scale = 1.0  # Downscale already applied to the stored frames by pre_label_tool
+
+        # Resized frames are cached and the next few in the navigation direction are prepared in the background
+        self.frame_cache = FrameCache(max_mb=512)
+        self.prefetcher = FramePrefetcher(self.frame_cache)
+        self.prefetch_count = 4  # Frames prefetched ahead (plus one behind)
+        self.nav_step = 1  # +1 after Next, -1 after Previous
 
         # Variables to handle drawing new bounding boxes
         self.drawing = False
@@ -32,6 +128,15 @@ class LabelTool:
         self.resize_margin = 10  # Margin to detect corners for resizing
         self.handle_size = 8  # Size of the resize handle
 
+        # Retained canvas items: the frame image is only replaced when the frame changes, and a drag only moves
+        # the dragged box's items; motion events are coalesced and the info panel refresh is throttled
+        self.image_item = None
+        self.photo_source = None  # Frame image the current PhotoImage was built from
+        self.pending_drag = None  # Latest motion event not applied yet
+        self.drag_job = None
+        self.info_job = None
+        self.info_refresh_ms = 100
+
         # Setup GUI
         self.canvas = tk.Canvas(root, bg='white')  # Set canvas background to white
         self.canvas.pack(expand=True, fill=tk.BOTH)
@@ -85,6 +190,7 @@ class LabelTool:
 
         # Create a menu for browsing folders later
         self.create_menu()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def create_menu(self):
         """Create a menu bar for browsing folders."""
@@ -98,6 +204,8 @@ class LabelTool:
         """Browse and select the images folder and automatically find labels and elements folders."""
         self.frame_folder = filedialog.askdirectory(title="Select Images Folder")
         if self.frame_folder:
+            # Write back the elements of the previously opened video before switching
+            self.close_store()
             # Extract subfolder name and automatically select corresponding labels folder
             subfolder_name = os.path.basename(self.frame_folder)
             subfolder_number = subfolder_name[-1]
@@ -123,11 +231,17 @@ class LabelTool:
                     with open(self.elements_file, mode='w', newline='') as file:
                         writer = csv.writer(file)
                         writer.writerow(['frame_id', 'class_id', 'color', 'action', 'gender'])
+                self.video = subfolder_number
+                self.element_store = open_store(self.elements_folder)
+                # Loaded once per video; a journal left by a crash is replayed first
+                journal_path = os.path.join(self.elements_folder, f"elements_{subfolder_number}.journal")
+                self.elements = ElementModel(self.element_store, self.video, journal_path)
             else:
                 messagebox.showerror("Error", f"Elements folder not found: {potential_elements_folder}")
                 self.elements_folder = ""
 
-            self.frames = sorted([f for f in os.listdir(self.frame_folder) if f.endswith('.png')])
+            self.stored_scale = get_stored_scale(self.output_folder) if self.output_folder else 1.0
+            self.frames = sorted([f for f in os.listdir(self.frame_folder) if f.lower().endswith(IMAGE_EXTENSIONS)])
             self.current_frame_index = 0
 
             # Check and load frame if both labels and elements folders are set
@@ -159,17 +273,16 @@ class LabelTool:
 
         frame_name = self.frames[self.current_frame_index]
         self.frame_path = os.path.join(self.frame_folder, frame_name)
-        self.current_frame = Image.open(self.frame_path)
-        self.img_w, self.img_h = self.current_frame.size
 
-        # Set the scale factor manually
-        self.scale_factor = self.scale_factor  
-
-        # Apply the scaling to the image
-        new_w = int(self.img_w * self.scale_factor)
-        new_h = int(self.img_h * self.scale_factor)
-        self.current_frame = self.current_frame.resize((new_w, new_h), Image.LANCZOS)
+        # Apply the scaling to the image, relative to the original resolution before any stored downscale
+        resize_factor = self.scale_factor / self.stored_scale
+        key = (self.frame_path, resize_factor)
+        self.current_frame = self.frame_cache.get(key)
+        if self.current_frame is None:
+            self.current_frame = load_resized(self.frame_path, resize_factor)
+            self.frame_cache.put(key, self.current_frame)
         self.img_w, self.img_h = self.current_frame.size
+        self.prefetch_frames(resize_factor)
 
         # Load corresponding bounding boxes from the file
         self.txt_path = os.path.join(self.output_folder, f"{os.path.splitext(frame_name)[0]}.txt")
@@ -190,22 +303,27 @@ class LabelTool:
         # Update detail information
         self.update_info_label()
 
+    def prefetch_frames(self, resize_factor):
+        """Queue the next frames in the navigation direction, and the one behind, for background loading."""
+        offsets = [self.nav_step * k for k in range(1, self.prefetch_count + 1)] + [-self.nav_step]
+        indices = []
+        for offset in offsets:
+            index = (self.current_frame_index + offset) % len(self.frames)
+            if index != self.current_frame_index and index not in indices:
+                indices.append(index)
+        self.prefetcher.request([(os.path.join(self.frame_folder, self.frames[index]), resize_factor)
+                                 for index in indices])
+
     def load_elements(self):
-        """Load elements information from the single CSV file."""
+        """Load elements information for the current frame from the in-memory element model."""
         self.frame_actions = {}  # Store actions for the current frame
-        if os.path.exists(self.elements_file):
-            with open(self.elements_file, mode='r', newline='') as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    frame_id = int(row['frame_id'])
-                    cls_id = int(row['class_id'])
-                    if frame_id == self.current_frame_index:
-                        # Load action and color for the current frame
-                        self.frame_actions[cls_id] = {'color': row['color'], 'action': row['action'], 'gender': row['gender']}
-                    elif cls_id not in self.frame_actions:
-                        # Load the latest action if not set in the current frame
-                        self.frame_actions[cls_id] = {'color': row['color'], 'action': row['action'], 'gender': row['gender']}
-        
+        # Classes without a row in the current frame use their first row in the video
+        for cls_id, row in self.elements.first_per_class().items():
+            self.frame_actions[cls_id] = {'color': row['color'], 'action': row['action'], 'gender': row['gender']}
+        # Load action and color for the current frame
+        for cls_id, row in self.elements.frame(self.current_frame_index).items():
+            self.frame_actions[cls_id] = {'color': row['color'], 'action': row['action'], 'gender': row['gender']}
+
         for bbox in self.bboxes:
             cls_id = bbox['class_id']
             if cls_id in self.frame_actions:
@@ -214,16 +332,27 @@ class LabelTool:
                 bbox['gender'] = self.frame_actions[cls_id]['gender']
 
     def display_frame(self):
-        # Clear the canvas before displaying the new frame
-        self.canvas.delete("all")
-        # Resize canvas to fit the image
-        self.canvas.config(width=self.img_w, height=self.img_h)
-        # Convert to PhotoImage
-        self.photo = ImageTk.PhotoImage(self.current_frame)
-        self.canvas.create_image(0, 0, image=self.photo, anchor=tk.NW)
+        if self.photo_source is not self.current_frame:
+            # Resize canvas to fit the image
+            self.canvas.config(width=self.img_w, height=self.img_h)
+            # Convert to PhotoImage, only when the frame itself changed
+            self.photo = ImageTk.PhotoImage(self.current_frame)
+            self.photo_source = self.current_frame
+            if self.image_item is None:
+                self.image_item = self.canvas.create_image(0, 0, image=self.photo, anchor=tk.NW)
+            else:
+                self.canvas.itemconfig(self.image_item, image=self.photo)
+        # Clear the boxes, the image item stays
+        self.canvas.delete("bbox")
         self.draw_bboxes()
         self.display_bbox_info()
 
+    def clear_canvas(self):
+        """Delete every canvas item, including the frame image."""
+        self.canvas.delete("all")
+        self.image_item = None
+        self.photo_source = None
+
     def update_info_label(self):
         """Update the information label with the current frame and labels details."""
         frame_name = self.frames[self.current_frame_index] 
@@ -239,30 +368,54 @@ class LabelTool:
         )
         self.info_label.config(text=info_text)
 
+    def display_coords(self, bbox):
+        """Scale bounding box coordinates for display."""
+        x = int(bbox['coords'][0] * self.scale_factor)
+        y = int(bbox['coords'][1] * self.scale_factor)
+        w = int(bbox['coords'][2] * self.scale_factor)
+        h = int(bbox['coords'][3] * self.scale_factor)
+        return x, y, w, h
+
     def draw_bboxes(self):
         for bbox in self.bboxes:
-            # Scale bounding box coordinates for display
-            x = int(bbox['coords'][0] * self.scale_factor)
-            y = int(bbox['coords'][1] * self.scale_factor)
-            w = int(bbox['coords'][2] * self.scale_factor)
-            h = int(bbox['coords'][3] * self.scale_factor)
+            x, y, w, h = self.display_coords(bbox)
             cls_id = bbox['class_id']
-            bbox['rect'] = self.canvas.create_rectangle(x, y, x + w, y + h, outline="red", width=2)
-            bbox['text'] = self.canvas.create_text(x, y - 10, text=f"ID: {cls_id}", fill="red")
+            # Every box item is tagged "bbox" so boxes can be cleared without touching the frame image
+            bbox['rect'] = self.canvas.create_rectangle(x, y, x + w, y + h, outline="red", width=2, tags="bbox")
+            bbox['text'] = self.canvas.create_text(x, y - 10, text=f"ID: {cls_id}", fill="red", tags="bbox")
             # Draw handles on each corner
-            self.draw_resize_handles(x, y, w, h)
+            bbox['handles'] = self.draw_resize_handles(x, y, w, h)
 
-    def draw_resize_handles(self, x, y, w, h):
-        """Draw small squares at the corners of the bounding box for resizing."""
+    def handle_corners(self, x, y, w, h):
         handle_radius = self.handle_size // 2
-        corners = [
+        return [
             (x - handle_radius, y - handle_radius, x + handle_radius, y + handle_radius),  # top-left
             (x + w - handle_radius, y - handle_radius, x + w + handle_radius, y + handle_radius),  # top-right
             (x - handle_radius, y + h - handle_radius, x + handle_radius, y + h + handle_radius),  # bottom-left
             (x + w - handle_radius, y + h - handle_radius, x + w + handle_radius, y + h + handle_radius)  # bottom-right
         ]
-        for cx, cy, ex, ey in corners:
-            self.canvas.create_rectangle(cx, cy, ex, ey, outline="blue", fill="blue")
+
+    def draw_resize_handles(self, x, y, w, h):
+        """Draw small squares at the corners of the bounding box for resizing; returns their item ids."""
+        return [self.canvas.create_rectangle(cx, cy, ex, ey, outline="blue", fill="blue", tags="bbox")
+                for cx, cy, ex, ey in self.handle_corners(x, y, w, h)]
+
+    def move_bbox_items(self, bbox):
+        """Move the existing canvas items of one box to its current coords."""
+        x, y, w, h = self.display_coords(bbox)
+        self.canvas.coords(bbox['rect'], x, y, x + w, y + h)
+        self.canvas.coords(bbox['text'], x, y - 10)
+        for handle, corner in zip(bbox['handles'], self.handle_corners(x, y, w, h)):
+            self.canvas.coords(handle, *corner)
+
+    def schedule_info_refresh(self):
+        """Refresh the bbox info box at most once per info_refresh_ms."""
+        if self.info_job is None:
+            self.info_job = self.root.after(self.info_refresh_ms, self.refresh_info)
+
+    def refresh_info(self):
+        self.info_job = None
+        self.display_bbox_info()
 
     def display_bbox_info(self):
         self.info_text.config(state='normal')
@@ -304,6 +457,7 @@ class LabelTool:
                 self.deleted_frame_info['label_data'] = lbl_file.read()
         
         # Delete image file
+        self.frame_cache.discard(image_path)
         try:
             os.remove(image_path)
         except OSError as e:
@@ -327,7 +481,7 @@ class LabelTool:
             self.load_frame()
         else:
             # Clear the canvas if no frames are left
-            self.canvas.delete("all")
+            self.clear_canvas()
             messagebox.showinfo("Info", "All frames deleted.")
 
     def undo_delete_frame(self):
@@ -370,12 +524,14 @@ class LabelTool:
 
     def prev_frame(self):
         self.save()
+        self.nav_step = -1
         # Move to the last frame if currently at the first frame
         self.current_frame_index = (self.current_frame_index - 1) % len(self.frames)
         self.load_frame()
     
     def next_frame(self):
         self.save()
+        self.nav_step = 1
         # Move to the first frame if currently at the last frame
         self.current_frame_index = (self.current_frame_index + 1) % len(self.frames)
         self.load_frame()
@@ -389,25 +545,13 @@ class LabelTool:
         self.show_temporary_message("Bounding boxes and elements saved successfully.", duration=1000)
 
     def save_elements(self):
-        """Save elements information to the single CSV file."""
-        elements_data = []
-        
-        # Load existing elements from the file
-        if os.path.exists(self.elements_file):
-            with open(self.elements_file, mode='r', newline='') as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    frame_id = int(row['frame_id'])
-                    class_id = int(row['class_id'])
-                    # Filter out invalid frame_id
-                    if 0 <= frame_id < len(self.frames):
-                        elements_data.append(row)
-
-        # Create a dictionary to quickly find existing (frame_id, class_id) pairs
-        elements_dict = {(int(row['frame_id']), int(row['class_id'])): row for row in elements_data}
-
-        # Add or update with current frame's data
+        """Save elements information of the current frame; only rows that changed are journaled and flushed."""
+        # Filter out invalid frame_id (frames past the end after a frame was deleted)
+        changed = self.elements.delete_from(len(self.frames))
+
+        # Add or update with current frame's data in one batch
         frame_id = self.current_frame_index
+        rows = []
         for bbox in self.bboxes:
             cls_id = bbox['class_id']
             
@@ -415,24 +559,37 @@ class LabelTool:
             if cls_id == 0:
                 continue
 
-            color = bbox.get('color', '')
-            action = bbox.get('action', '')
-            gender = bbox.get('gender', '')
-
-            # Check if the (frame_id, class_id) already exists
-            if (frame_id, cls_id) in elements_dict:
-                # Update the existing entry
-                elements_dict[(frame_id, cls_id)] = {'frame_id': frame_id, 'class_id': cls_id, 'color': color, 'action': action, 'gender': gender}
-            else:
-                # Add new entry if not existing
-                elements_dict[(frame_id, cls_id)] = {'frame_id': frame_id, 'class_id': cls_id, 'color': color, 'action': action, 'gender': gender}
-
-        # Write back to CSV with updated elements
-        with open(self.elements_file, mode='w', newline='') as file:
-            writer = csv.DictWriter(file, fieldnames=['frame_id', 'class_id', 'color', 'action', 'gender'])
-            writer.writeheader()
-            for data in elements_dict.values():
-                writer.writerow(data)
+            rows.append({'frame_id': frame_id, 'class_id': cls_id, 'color': bbox.get('color', ''),
+                         'action': bbox.get('action', ''), 'gender': bbox.get('gender', '')})
+        changed = self.elements.set_rows(rows) or changed
+
+        if changed:
+            # Restart the idle timer; the store is only written once navigation pauses
+            if self.flush_job is not None:
+                self.root.after_cancel(self.flush_job)
+            self.flush_job = self.root.after(self.flush_delay_ms, self.flush_elements)
+
+    def flush_elements(self):
+        """Write the changed elements to the store and empty the journal."""
+        self.flush_job = None
+        if self.elements is not None:
+            self.elements.flush()
+
+    def close_store(self):
+        """Flush the elements, write the element store back to the elements CSV and close it."""
+        if self.element_store is None:
+            return
+        if self.flush_job is not None:
+            self.root.after_cancel(self.flush_job)
+        self.flush_elements()
+        self.elements = None
+        self.element_store.export_csv(self.video, self.elements_file)
+        self.element_store.close()
+        self.element_store = None
+
+    def on_close(self):
+        self.close_store()
+        self.root.destroy()
 
     def enable_drawing(self, event):
         """Enable drawing mode when 'H' key is pressed.""" 
@@ -470,11 +627,23 @@ class LabelTool:
     def on_mouse_drag(self, event):
         if self.drawing:
             if self.current_rect:
-                self.canvas.delete(self.current_rect)
-            self.current_rect = self.canvas.create_rectangle(
-                self.start_x, self.start_y, event.x, event.y, outline="blue", width=2
-            )
+                self.canvas.coords(self.current_rect, self.start_x, self.start_y, event.x, event.y)
+            else:
+                self.current_rect = self.canvas.create_rectangle(
+                    self.start_x, self.start_y, event.x, event.y, outline="blue", width=2
+                )
         elif self.resizing:
+            # Only the latest position matters: events that arrive before the next idle replace each other
+            self.pending_drag = event
+            if self.drag_job is None:
+                self.drag_job = self.root.after_idle(self.apply_drag)
+
+    def apply_drag(self):
+        """Resize the dragged box to the latest motion event and move only its canvas items."""
+        self.drag_job = None
+        event = self.pending_drag
+        self.pending_drag = None
+        if event is not None and self.resizing:
             # Update bounding box size based on mouse drag
             if self.resizing_bbox:
                 bx = int(self.resizing_bbox['coords'][0] * self.scale_factor)
@@ -499,13 +668,18 @@ class LabelTool:
                     new_w = max(1, (bx + bw) - event.x)
                     new_h = max(1, event.y - by)
                     self.resizing_bbox['coords'] = (event.x / self.scale_factor, by / self.scale_factor, new_w / self.scale_factor, new_h / self.scale_factor)
-                self.display_frame()  # Redraw everything
+                if 'handles' in self.resizing_bbox:
+                    self.move_bbox_items(self.resizing_bbox)
+                else:
+                    self.display_frame()  # Box not drawn yet (e.g. restored by undo), redraw the boxes
+                self.schedule_info_refresh()
 
     def on_mouse_release(self, event):
         if self.drawing:
             self.drawing = False
             if self.current_rect:
                 self.canvas.delete(self.current_rect)
+                self.current_rect = None
             # Create a new bounding box
             x1, y1 = min(self.start_x, event.x), min(self.start_y, event.y)
             x2, y2 = max(self.start_x, event.x), max(self.start_y, event.y)
@@ -517,6 +691,11 @@ class LabelTool:
             self.display_frame()  # Redraw everything
             self.open_edit_dialog(new_bbox)  # Prompt to set ID
         elif self.resizing:
+            # Apply the last coalesced motion and show the final coords right away
+            if self.drag_job is not None:
+                self.root.after_cancel(self.drag_job)
+                self.apply_drag()
+            self.display_bbox_info()
             self.resizing = False
             self.resizing_bbox = None
 
@@ -670,6 +849,14 @@ class LabelTool:
             return 'bottom-left'
         return None
 
+def get_stored_scale(labels_folder):
+    """Read the stored-frame downscale recorded by pre_label_tool in the video's progress.json (1.0 if absent)."""
+    progress_path = os.path.join(labels_folder, "progress.json")
+    if not os.path.exists(progress_path):
+        return 1.0
+    with open(progress_path, 'r') as f:
+        return json.load(f).get('image_scale', 1.0)
+
 def get_bounding_boxes(txt_path, img_w, img_h):
     """Read bounding boxes from txt file."""
     boxes = []
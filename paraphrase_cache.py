@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def normalize_sentence(sentence):
+    """Cache form of a sentence: lowercase with whitespace collapsed, so trivial variants share an entry."""
+    return " ".join(sentence.lower().split())
+
+
+class ParaphraseCache:
+    """Content-addressed SQLite store of paraphrases, keyed by normalized sentence, model and temperature.
+
+    Each key holds the list of distinct paraphrases collected so far. When the stored text grows past
+    max_bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path="paraphrase_cache.sqlite", max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()  # One connection shared by the client's worker threads
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)  # Worker processes share the file
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS paraphrases ("
+            "key TEXT PRIMARY KEY, sentence TEXT, model TEXT, temperature REAL, "
+            "paraphrases TEXT, size INTEGER, last_used REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS paraphrases_last_used ON paraphrases (last_used)")
+        self.conn.commit()
+
+    @staticmethod
+    def key(sentence, model, temperature):
+        text = f"{model}\0{temperature}\0{normalize_sentence(sentence)}"
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, sentence, model, temperature):
+        """Cached paraphrases of the sentence (empty list on a miss); a hit refreshes its LRU position."""
+        key = self.key(sentence, model, temperature)
+        with self.lock:
+            row = self.conn.execute("SELECT paraphrases FROM paraphrases WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return []
+            self.conn.execute("UPDATE paraphrases SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def add(self, sentence, model, temperature, paraphrases):
+        """Append the paraphrases not stored yet to the sentence's entry, then evict past max_bytes."""
+        key = self.key(sentence, model, temperature)
+        with self.lock:
+            row = self.conn.execute("SELECT paraphrases FROM paraphrases WHERE key = ?", (key,)).fetchone()
+            stored = json.loads(row[0]) if row else []
+            new = [paraphrase for paraphrase in dict.fromkeys(paraphrases) if paraphrase not in stored]
+            if not new:
+                return
+            value = json.dumps(stored + new)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO paraphrases VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, normalize_sentence(sentence), model, temperature, value, len(key) + len(value), time.time()),
+            )
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM paraphrases").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop the oldest entries until the store fits again
+        rows = self.conn.execute("SELECT key, size FROM paraphrases ORDER BY last_used").fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM paraphrases WHERE key = ?", stale)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
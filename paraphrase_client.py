@@ -0,0 +1,168 @@
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+from openai import error as openai_error
+
+from paraphrase_cache import normalize_sentence
+
+# Errors worth retrying: the request itself was fine, the API was busy or unreachable
+RETRYABLE_ERRORS = (
+    openai_error.RateLimitError,
+    openai_error.Timeout,
+    openai_error.APIConnectionError,
+    openai_error.ServiceUnavailableError,
+    openai_error.TryAgain,
+)
+
+
+def clean_candidate(text):
+    """Strip list numbering, surrounding quotes and extra whitespace from a model answer."""
+    text = re.sub(r"^\s*\d+[.)]\s*", "", text.strip())
+    return " ".join(text.strip().strip('"\'').split())
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute token buckets shared by all worker threads."""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.lock = threading.Lock()
+        # Each bucket is [capacity, current level, refill per second]; None disables that limit
+        self.request_bucket = self._bucket(requests_per_minute)
+        self.token_bucket = self._bucket(tokens_per_minute)
+        self.last_refill = time.monotonic()
+
+    @staticmethod
+    def _bucket(per_minute):
+        return [per_minute, per_minute, per_minute / 60.0] if per_minute else None
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        for bucket in (self.request_bucket, self.token_bucket):
+            if bucket:
+                bucket[1] = min(bucket[0], bucket[1] + elapsed * bucket[2])
+
+    def acquire(self, tokens=1):
+        """Block until one request using about `tokens` tokens fits in both budgets, then spend it."""
+        while True:
+            with self.lock:
+                self._refill()
+                wait = 0.0
+                needs = []
+                if self.request_bucket:
+                    needs.append((self.request_bucket, 1))
+                if self.token_bucket:
+                    # A single request larger than the whole budget still has to go through eventually
+                    needs.append((self.token_bucket, min(tokens, self.token_bucket[0])))
+                for bucket, need in needs:
+                    if bucket[1] < need:
+                        wait = max(wait, (need - bucket[1]) / bucket[2])
+                if wait <= 0:
+                    for bucket, need in needs:
+                        bucket[1] -= need
+                    return
+            time.sleep(wait)
+
+
+class ParaphraseClient:
+    """Chat-completion paraphraser with bounded concurrency, rate limiting, retries and per-request timeouts.
+
+    api_base can point at any OpenAI-compatible endpoint, e.g. a local stub server for tests.
+    Each request asks for several candidates at once (the API's `n` parameter) instead of one call per sentence.
+    With a ParaphraseCache, successful paraphrases are stored so reruns can reuse them instead of calling the API.
+    """
+
+    def __init__(self, model="gpt-3.5-turbo", temperature=0.7, max_tokens=60, concurrency=8,
+                 requests_per_minute=None, tokens_per_minute=None, max_retries=5, backoff_base=1.0,
+                 backoff_max=30.0, timeout=30.0, api_base=None, api_key=None, cache=None):
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.api_base = api_base
+        self.api_key = api_key
+        self.cache = cache
+
+    def _messages(self, sentence):
+        return [
+            {"role": "system", "content": "You are a helpful assistant that paraphrases sentences."},
+            {"role": "user", "content": f"Paraphrase the following sentence: '{sentence}'"}
+        ]
+
+    def _create(self, messages, n=1):
+        """One chat completion call, retried with exponential backoff on rate limits and transient errors."""
+        # Rough token estimate (4 characters per token) plus the completion budget of every candidate
+        estimated_tokens = sum(len(message["content"]) for message in messages) // 4 + self.max_tokens * n
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(estimated_tokens)
+            try:
+                return openai.ChatCompletion.create(
+                    model=self.model,
+                    messages=messages,
+                    n=n,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    request_timeout=self.timeout,
+                    api_base=self.api_base,
+                    api_key=self.api_key,
+                )
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt, e))
+            except openai_error.APIError as e:
+                # Server-side 5xx errors are transient too; anything else is a real failure
+                if attempt == self.max_retries or (e.http_status or 0) < 500:
+                    raise
+                time.sleep(self._backoff(attempt, e))
+
+    def _backoff(self, attempt, error):
+        """Seconds to wait before the next attempt: the server's Retry-After if given, else jittered 2^attempt."""
+        retry_after = (getattr(error, "headers", None) or {}).get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.0)
+
+    def cached(self, sentence):
+        """Paraphrases of the sentence already in the cache, oldest first."""
+        if self.cache is None:
+            return []
+        return self.cache.get(sentence, self.model, self.temperature)
+
+    def paraphrase(self, sentence, n=1):
+        """Up to n distinct paraphrases of the sentence from one API call; empty if every attempt fails."""
+        try:
+            response = self._create(self._messages(sentence), n)
+        except Exception as e:
+            print(f"Error during paraphrasing: {e}")
+            return []
+        paraphrases = {}
+        for choice in response['choices']:
+            candidate = clean_candidate(choice['message']['content'])
+            key = normalize_sentence(candidate)
+            # Candidates that only differ in case or spacing, or just repeat the input, don't count
+            if key and key != normalize_sentence(sentence):
+                paraphrases.setdefault(key, candidate)
+        paraphrases = list(paraphrases.values())
+        if self.cache is not None and paraphrases:
+            self.cache.add(sentence, self.model, self.temperature, paraphrases)
+        return paraphrases
+
+    def map(self, fn, items):
+        """Run fn over items on `concurrency` threads and return the results in input order."""
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(fn, items))
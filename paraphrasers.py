@@ -0,0 +1,165 @@
+"""Paraphrase backends for expression.py, all with the same interface as ParaphraseClient:
+
+    paraphraser.cached(sentence) -> paraphrases stored by earlier runs (may be empty)
+    paraphraser.paraphrase(sentence, n) -> up to n distinct paraphrases, never the sentence itself
+    paraphraser.map(fn, items) -> [fn(item) for item in items], possibly run concurrently
+
+    "openai" - chat-completion API (paraphrase_client.ParaphraseClient), network bound.
+    "local"  - LocalParaphraser: offline grammar and synonym rewrites of prompt_gen sentences.
+"""
+import random
+import re
+import zlib
+
+from paraphrase_cache import normalize_sentence
+from prompt_gen import templates
+
+PARAPHRASERS = ("openai", "local")
+
+SUBJECTS = ["a person", "the person", "someone", "an individual", "the individual"]
+CLOTHING = ["wearing {color}", "dressed in {color}", "in {color}", "with {color}", "clad in {color}"]
+# Synonyms are kept to ones that don't change what the annotated person looks like or does
+COLOR_SYNONYMS = {"grey": ["grey", "gray"], "gray": ["gray", "grey"], "navy": ["navy", "navy blue"]}
+GARMENT_SYNONYMS = {
+    "jacket": ["jacket", "coat"],
+    "coat": ["coat", "jacket"],
+    "uniform": ["uniform", "work uniform"],
+    "shirt": ["shirt", "top"],
+    "t-shirt": ["t-shirt", "tee"],
+    "hoodie": ["hoodie", "hooded sweatshirt"],
+    "sweater": ["sweater", "jumper"],
+}
+ACTION_SYNONYMS = {
+    "checking out": ["checking out", "paying at the checkout", "at the checkout"],
+    "waiting checkout": ["waiting for checkout", "waiting at the checkout", "waiting in line to pay"],
+    "walking": ["walking", "walking around", "on the move"],
+    "standing": ["standing", "standing still", "standing around"],
+    "buying": ["buying", "making a purchase", "shopping"],
+    "working": ["working", "at work", "on duty"],
+}
+# {subject} is a SUBJECTS entry, {clothing} a CLOTHING entry, {action} an ACTION_SYNONYMS entry
+BOTH_PATTERNS = [
+    "{subject} {clothing} who is {action}",
+    "{subject} {clothing}, {action}",
+    "{subject} {clothing} is {action}",
+    "{subject} {clothing} can be seen {action}",
+    "{subject} who is {action}, {clothing}",
+    "{subject} {action} {clothing}",
+    "{action_cap}: {subject} {clothing}",
+]
+COLOR_PATTERNS = ["{subject} {clothing}", "{subject} who is {clothing}", "{subject} is {clothing}"]
+ACTION_PATTERNS = ["{subject} who is {action}", "{subject} {action}", "{subject} is {action}",
+                   "{subject} can be seen {action}"]
+EMPTY_PATTERNS = ["a person", "someone", "an individual", "one person"]
+
+
+def _template_pattern(template):
+    """Regex reading color and action back out of a prompt_gen template."""
+    pattern = re.escape(template)
+    pattern = pattern.replace(re.escape("{color}"), r"(?P<color>.+?)")
+    pattern = pattern.replace(re.escape("{action}"), r"(?P<action>.+?)")
+    return re.compile(f"^{pattern}$", re.IGNORECASE)
+
+
+# Every sentence shape prompt_gen.generate_prompt_file can write. Longest literal text first, so that
+# "{action} person in a {color}." can't swallow "A person in a {color} engaged in {action}."
+SENTENCE_PATTERNS = [
+    _template_pattern(template)
+    for template in sorted(templates + ["A person wearing a {color}.", "A person who is {action}."],
+                           key=lambda template: -len(re.sub(r"\{\w+\}", "", template)))
+]
+
+
+def parse_sentence(sentence):
+    """(color, action) of a prompt_gen sentence, '' for a missing part; None if it isn't one of its shapes."""
+    sentence = " ".join(sentence.split())
+    if sentence.lower() == "a person.":
+        return "", ""
+    for pattern in SENTENCE_PATTERNS:
+        match = pattern.match(sentence)
+        if match:
+            groups = match.groupdict()
+            return (groups.get("color") or "").lower(), (groups.get("action") or "").lower()
+    return None
+
+
+def with_article(phrase):
+    return f"{'an' if phrase[:1] in 'aeiou' else 'a'} {phrase}"
+
+
+class LocalParaphraser:
+    """Offline paraphraser: rebuilds prompt_gen sentences with other subjects, clause orders, verbs and synonyms.
+
+    Output is deterministic for a given seed and sentence, and needs no network, so it also works air-gapped.
+    """
+
+    def __init__(self, seed=0, draws_per_candidate=6):
+        self.seed = seed
+        self.draws_per_candidate = draws_per_candidate
+
+    def _rng(self, sentence):
+        # Seeded per sentence (not per call order), so results don't depend on which thread or process runs it
+        return random.Random(zlib.crc32(f"{self.seed}\0{normalize_sentence(sentence)}".encode("utf-8")))
+
+    @staticmethod
+    def _colors(color):
+        """Synonym options of a color phrase such as 'black jacket': one list per color word, one for the garment."""
+        words = color.split()
+        colors = [COLOR_SYNONYMS.get(word, [word]) for word in words[:-1]]
+        garments = GARMENT_SYNONYMS.get(words[-1], [words[-1]]) if words else []
+        return colors, garments
+
+    def _draw(self, rng, color, action):
+        values = {"subject": rng.choice(SUBJECTS)}
+        if color:
+            colors, garments = self._colors(color)
+            phrase = " ".join([rng.choice(options) for options in colors] + [rng.choice(garments)])
+            values["clothing"] = rng.choice(CLOTHING).format(color=with_article(phrase))
+        if action:
+            values["action"] = rng.choice(ACTION_SYNONYMS.get(action, [action]))
+            values["action_cap"] = values["action"][:1].upper() + values["action"][1:]
+        if color and action:
+            pattern = rng.choice(BOTH_PATTERNS)
+        elif color:
+            pattern = rng.choice(COLOR_PATTERNS)
+        elif action:
+            pattern = rng.choice(ACTION_PATTERNS)
+        else:
+            pattern = rng.choice(EMPTY_PATTERNS)
+        text = pattern.format(**values)
+        return text[0].upper() + text[1:] + "."
+
+    def cached(self, sentence):
+        return []
+
+    def paraphrase(self, sentence, n=1):
+        parsed = parse_sentence(sentence)
+        if parsed is None:
+            return []
+        rng = self._rng(sentence)
+        seen = {normalize_sentence(sentence)}
+        paraphrases = []
+        for _ in range(n * self.draws_per_candidate):
+            candidate = self._draw(rng, *parsed)
+            key = normalize_sentence(candidate)
+            if key not in seen:
+                seen.add(key)
+                paraphrases.append(candidate)
+                if len(paraphrases) == n:
+                    break
+        return paraphrases
+
+    def map(self, fn, items):
+        # CPU-bound and fast, threads would only add overhead
+        return [fn(item) for item in items]
+
+
+def load_paraphraser(name="openai", cache=None, **options):
+    """Create a paraphraser by name; options go to its constructor, cache is only used by "openai"."""
+    if name == "openai":
+        # Imported here so the local backend works without the openai package
+        from paraphrase_client import ParaphraseClient
+        return ParaphraseClient(cache=cache, **options)
+    if name == "local":
+        return LocalParaphraser(**options)
+    raise ValueError(f"Unknown paraphraser: {name}")
@@ -1,89 +1,684 @@
+import argparse
+import csv
 import cv2
+import hashlib
+import io
+import json
+import numpy as np
 import os
-from ultralytics import YOLO
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from pathlib import Path
 from tqdm import tqdm
+from detector_backends import BACKENDS, CascadeBackend, load_backend, prepare_model
+from tracker import IoUTracker
 
-def extract_and_detect(video_path, frame_output_folder, label_output_folder, frame_interval=0.5):
+PERSON_CLASS = 0  # Chỉ lưu bounding box của class "person"
+LABEL_FORMAT = "0 %d %.6f %.6f %.6f %.6f"  # "0 id x_center y_center width height"
+
+
+def write_boxes(txt_path, ids, xywhn, conf=None):
+    """Ghi toàn bộ nhãn của một frame bằng một lần write; conf (nếu có) là cột thứ 7."""
+    xywhn = np.asarray(xywhn, dtype=np.float64).reshape(-1, 4)
+    columns = [np.asarray(ids, dtype=np.float64), xywhn]
+    fmt = LABEL_FORMAT
+    if conf is not None:
+        columns.append(np.asarray(conf, dtype=np.float64))
+        fmt += " %.4f"
+    buffer = io.StringIO()
+    np.savetxt(buffer, np.column_stack(columns), fmt=fmt)
+    with open(txt_path, 'w') as f:
+        f.write(buffer.getvalue())
+    print(f"Saved {txt_path}")
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')  # Các định dạng frame được ghi ra (và label_tool đọc được)
+
+
+def image_encode_params(image_format="png", quality=None, png_compression=None):
+    """Tham số cv2.imwrite cho định dạng ảnh đã chọn; None giữ mặc định của OpenCV."""
+    if image_format == "png":
+        return [cv2.IMWRITE_PNG_COMPRESSION, png_compression] if png_compression is not None else []
+    if image_format in ("jpg", "jpeg"):
+        return [cv2.IMWRITE_JPEG_QUALITY, quality] if quality is not None else []
+    if image_format == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, quality] if quality is not None else []
+    raise ValueError(f"Unknown image format: {image_format}")
+
+
+def save_frame(frame_name, frame, encode_params=(), scale=1.0):
+    # Thu nhỏ trước khi lưu nếu được yêu cầu; nhãn chuẩn hóa nên không phụ thuộc kích thước ảnh lưu
+    if scale != 1.0:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # Lưu frame dưới dạng hình ảnh
+    cv2.imwrite(frame_name, frame, list(encode_params))
+    print(f"Saved {frame_name}")
+
+
+def _run_now(fn, *args):
+    """Ghi file ngay trên thread hiện tại (chế độ không pipeline)."""
+    fn(*args)
+
+
+def detect_batch(model, batch, label_output_folder, submit=_run_now, conf_threshold=0.0, save_conf=False):
+    """Chạy YOLO một lần cho cả batch [(save_count, frame), ...] rồi tách kết quả ra từng file .txt.
+
+    Không theo dõi: mọi box được ghi với ID bằng class 0, người gán nhãn tự đặt ID trong label_tool.
+    """
+    if not batch:
+        return
+    detections = model.detect([frame for _, frame in batch], conf_threshold)
+    for (save_count, _), (xywhn, conf) in zip(batch, detections):
+        # Tạo tên file .txt tương ứng
+        txt_path = os.path.join(label_output_folder, f"{save_count:06}.txt")
+        submit(write_boxes, txt_path, np.full(len(xywhn), PERSON_CLASS), xywhn, conf if save_conf else None)
+
+
+def track_batch(model, batch, label_output_folder, tracker, keyframe_interval, submit=_run_now, conf_threshold=0.0):
+    """Như detect_batch nhưng chỉ chạy YOLO trên keyframe (save_count % keyframe_interval == 0).
+
+    Keyframe ghi đúng box YOLO (tracker.update trả về detection đã ghép), các frame còn lại lấy box từ
+    tracker.predict(); mọi box được ghi kèm ID track thật ở cột thứ hai.
+    Box lan truyền không có confidence nên chế độ này không ghi cột conf.
+    """
+    if not batch:
+        return
+    keyframes = [(save_count, frame) for save_count, frame in batch if save_count % keyframe_interval == 0]
+    detections = {}
+    if keyframes:
+        keyframe_detections = model.detect([frame for _, frame in keyframes], conf_threshold)
+        for (save_count, _), (xywhn, _) in zip(keyframes, keyframe_detections):
+            detections[save_count] = xywhn.tolist()
+
+    # Tracker phải đi đúng thứ tự frame: update tại keyframe, predict ở giữa
+    for save_count, _ in batch:
+        if save_count in detections:
+            tracked_boxes = tracker.update(detections[save_count])
+        else:
+            tracked_boxes = tracker.predict()
+        txt_path = os.path.join(label_output_folder, f"{save_count:06}.txt")
+        submit(write_boxes, txt_path, [track_id for track_id, _ in tracked_boxes], [box for _, box in tracked_boxes])
+
+
+class BackgroundWriter:
+    """Thread pool ghi PNG và file nhãn, giới hạn số tác vụ đang chờ để bộ nhớ không tăng theo độ dài video."""
+
+    def __init__(self, threads=4, max_pending=32):
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = max_pending
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.error = None
+
+    def submit(self, fn, *args):
+        # Chặn stage suy luận khi đĩa ghi không kịp, thay vì dồn frame vào bộ nhớ
+        self.slots.acquire()
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception() is not None and self.error is None:
+            self.error = future.exception()
+
+    def drain(self):
+        """Chờ mọi file đã gửi được ghi xong (trước khi ghi checkpoint); báo lại lỗi ghi đầu tiên (nếu có)."""
+        # Giữ được hết các slot nghĩa là không còn tác vụ nào đang chờ
+        for _ in range(self.max_pending):
+            self.slots.acquire()
+        for _ in range(self.max_pending):
+            self.slots.release()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Chờ ghi xong mọi file; báo lại lỗi ghi đầu tiên (nếu có)."""
+        self.executor.shutdown(wait=True)
+        if self.error is not None:
+            raise self.error
+
+
+def prefetch(iterable, queue_size=16):
+    """Chạy iterable (stage decode) trên thread riêng, đẩy kết quả qua hàng đợi có giới hạn queue_size."""
+    items = queue.Queue(maxsize=queue_size)
+    done = object()
+    stop = threading.Event()
+    errors = []
+
+    def producer():
+        try:
+            for item in iterable:
+                # put có timeout để thread thoát được khi bên tiêu thụ dừng giữa chừng
+                while not stop.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            while not stop.is_set():
+                try:
+                    items.put(done, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+DEFAULT_FPS = 30.0  # Dùng khi video không khai báo FPS (hoặc FPS = 0/NaN)
+MANIFEST_NAME = "frames.csv"  # Danh sách frame lấy mẫu (giữ/bỏ) của từng video, nằm trong thư mục nhãn
+PROGRESS_NAME = "progress.json"  # Checkpoint của từng video (frame đã xong, mốc tiếp tục), nằm trong thư mục nhãn
+CORPUS_MANIFEST_NAME = "prelabel_manifest.json"  # Manifest của cả bộ video, nằm trong thư mục nhãn gốc
+SEEK_MIN_INTERVAL = 2.0  # Khoảng cắt (giây) từ mức này trở lên thì chế độ "auto" chuyển sang seek
+
+
+def get_video_fps(cap):
+    """Lấy FPS của video, trả về DEFAULT_FPS nếu container không có giá trị hợp lệ."""
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if not fps or fps != fps or fps <= 0:  # fps != fps: NaN
+        return DEFAULT_FPS
+    return fps
+
+
+def _frame_timestamp(cap, frame_index, fps):
+    """Thời điểm (ms) của frame vừa grab/read; dùng frame_index / fps nếu backend không trả timestamp."""
+    timestamp = cap.get(cv2.CAP_PROP_POS_MSEC)
+    if timestamp > 0 or frame_index == 0:
+        return timestamp
+    return frame_index * 1000.0 / fps
+
+
+def sample_frames(cap, frame_interval=0.5, sampling="auto", start_ms=0.0):
+    """Sinh ra (frame_index, timestamp_ms, frame) cho các frame được lấy mẫu, bắt đầu từ mốc start_ms.
+
+    sampling:
+        "read"  - decode mọi frame, giữ 1 frame mỗi interval_frame_count frame (cách cũ).
+        "grab"  - grab() mọi frame nhưng chỉ retrieve() frame được giữ; chọn theo timestamp nên đúng cả với video VFR.
+        "seek"  - nhảy thẳng tới timestamp tiếp theo bằng CAP_PROP_POS_MSEC; chỉ có lợi khi khoảng cắt dài.
+        "auto"  - "seek" nếu frame_interval >= SEEK_MIN_INTERVAL, ngược lại "grab".
+    """
+    fps = get_video_fps(cap)
+    if sampling == "auto":
+        sampling = "seek" if frame_interval >= SEEK_MIN_INTERVAL else "grab"
+
+    frame_index = 0
+    if start_ms > 0 and sampling != "seek":
+        # Tiếp tục video dở dang: lùi nửa frame để không lỡ frame nằm đúng mốc start_ms
+        cap.set(cv2.CAP_PROP_POS_MSEC, max(0.0, start_ms - 500.0 / fps))
+        frame_index = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+    if sampling == "read":
+        # Số frame giữa mỗi lần cắt, tối thiểu 1 để tránh chia cho 0 khi frame_interval < 1 / fps
+        interval_frame_count = max(1, int(frame_interval * fps))
+        while cap.isOpened():
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if frame_index % interval_frame_count == 0:
+                yield frame_index, _frame_timestamp(cap, frame_index, fps), frame
+            frame_index += 1
+
+    elif sampling == "grab":
+        interval_ms = frame_interval * 1000.0
+        # Cho phép lệch nửa frame để timestamp làm tròn (vd. 499.99ms) vẫn được tính là tới hạn
+        tolerance_ms = 500.0 / fps
+        next_timestamp = start_ms
+        while cap.isOpened():
+            if not cap.grab():
+                break
+            timestamp = _frame_timestamp(cap, frame_index, fps)
+            if timestamp + tolerance_ms >= next_timestamp:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+                yield frame_index, timestamp, frame
+                # Bỏ qua các mốc đã trôi qua (video VFR có thể nhảy cóc nhiều interval một lúc)
+                while next_timestamp <= timestamp + tolerance_ms:
+                    next_timestamp += interval_ms
+            frame_index += 1
+
+    elif sampling == "seek":
+        interval_ms = frame_interval * 1000.0
+        target = start_ms
+        last_timestamp = -1.0
+        while cap.isOpened():
+            cap.set(cv2.CAP_PROP_POS_MSEC, target)
+            ret, frame = cap.read()
+            if not ret:
+                break
+            # Sau read(), POS_FRAMES trỏ tới frame kế tiếp nên frame vừa đọc là POS_FRAMES - 1
+            frame_index = max(0, int(cap.get(cv2.CAP_PROP_POS_FRAMES)) - 1)
+            timestamp = cap.get(cv2.CAP_PROP_POS_MSEC)
+            if timestamp <= last_timestamp:
+                # Backend không seek được (hoặc đã tới cuối): dừng thay vì lặp mãi trên cùng một frame
+                break
+            last_timestamp = timestamp
+            yield frame_index, timestamp, frame
+            target = max(target + interval_ms, timestamp + 1)
+
+    else:
+        raise ValueError(f"Unknown sampling mode: {sampling}")
+
+
+class ChangeGate:
+    """Bỏ qua frame gần như giống hệt frame được giữ gần nhất (cảnh tĩnh) trước khi lưu ảnh và chạy YOLO.
+
+    So sánh ảnh xám thu nhỏ thumb_size bằng độ lệch tuyệt đối trung bình (0-255);
+    frame bị bỏ nếu độ lệch nhỏ hơn threshold.
+    """
+
+    def __init__(self, threshold=2.0, thumb_size=(64, 36)):
+        self.threshold = threshold
+        self.thumb_size = thumb_size
+        self.last_kept = None
+
+    def is_static(self, frame):
+        thumb = cv2.resize(frame, self.thumb_size, interpolation=cv2.INTER_AREA)
+        if thumb.ndim == 3:
+            thumb = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+        if self.last_kept is not None and cv2.absdiff(thumb, self.last_kept).mean() < self.threshold:
+            return True
+        # Luôn so với frame được giữ gần nhất để chuyển động chậm vẫn cộng dồn tới ngưỡng
+        self.last_kept = thumb
+        return False
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-1 nội dung file, đọc theo từng khối để không phải nạp cả video vào bộ nhớ."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_json_atomic(path, data):
+    """Ghi JSON qua file tạm rồi os.replace để bị ngắt giữa chừng cũng không để lại file hỏng."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def _trim_frame_manifest(manifest_path, resume_ms):
+    """Bỏ các dòng frames.csv từ mốc resume_ms trở đi (sẽ được xử lý lại khi tiếp tục video)."""
+    if not os.path.exists(manifest_path):
+        return
+    with open(manifest_path, 'r', newline='') as f:
+        rows = [row for row in csv.DictReader(f) if float(row['timestamp_ms']) < resume_ms]
+    with open(manifest_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['source_frame', 'timestamp_ms', 'saved_frame', 'status'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def extract_and_detect(video_path, frame_output_folder, label_output_folder, frame_interval=0.5, batch_size=1,
+                       sampling="auto", model=None, model_path="yolov8l.pt", pipeline=False, queue_size=16,
+                       writer_threads=4, keyframe_interval=0, tracker_options=None, skip_threshold=0, resume=False,
+                       checkpoint_every=50, image_options=None, conf_threshold=0.0, save_conf=False,
+                       backend_options=None):
+    """Cắt frame từ video, lưu ảnh và nhãn person; trả về số frame đã lưu.
+
+    keyframe_interval > 0 bật chế độ keyframe: YOLO chỉ chạy mỗi keyframe_interval frame lấy mẫu,
+    tracker.IoUTracker(**tracker_options) lan truyền box và ghi ID track thật cho các frame ở giữa.
+    skip_threshold > 0 bật ChangeGate: frame lấy mẫu gần như không đổi so với frame được giữ trước đó bị bỏ qua.
+    Mọi frame lấy mẫu (giữ hoặc bỏ) được ghi vào label_output_folder/MANIFEST_NAME để đối chiếu số thứ tự
+    frame đã lưu với frame gốc trong video.
+    Sau mỗi checkpoint_every frame đã ghi xong, tiến độ được lưu vào label_output_folder/PROGRESS_NAME;
+    resume=True tiếp tục từ checkpoint đó thay vì làm lại từ đầu.
+    image_options: {'format': "png"|"jpg"|"webp", 'quality': 0-100, 'png_compression': 0-9, 'scale': tỉ lệ thu nhỏ
+    ảnh lưu}; mặc định PNG đầy đủ kích thước như cũ. Tỉ lệ thu nhỏ được ghi vào checkpoint ('image_scale') để
+    label_tool hiển thị đúng kích thước.
+    Chỉ box person có confidence >= conf_threshold được ghi; save_conf=True thêm confidence làm cột thứ 7
+    (bỏ qua ở chế độ keyframe).
+    model là một backend của detector_backends; nếu None sẽ tạo bằng load_backend(model_path, **backend_options).
+    """
+    image_options = image_options or {}
+    image_format = image_options.get('format', "png")
+    image_scale = image_options.get('scale', 1.0)
+    encode_params = image_encode_params(image_format, image_options.get('quality'), image_options.get('png_compression'))
     # Tạo thư mục nếu chưa tồn tại
     if not os.path.exists(frame_output_folder):
         os.makedirs(frame_output_folder)
     if not os.path.exists(label_output_folder):
         os.makedirs(label_output_folder)
 
+    progress_path = os.path.join(label_output_folder, PROGRESS_NAME)
+    manifest_path = os.path.join(label_output_folder, MANIFEST_NAME)
+    state = read_json(progress_path) if resume else None
+    if state and state['done']:
+        return state['save_count']
+    save_count = state['save_count'] if state else 0
+    start_ms = state['resume_ms'] if state else 0.0
+
     # Mở video
     cap = cv2.VideoCapture(str(video_path))  # Chuyển đổi video_path thành chuỗi
-    fps = cap.get(cv2.CAP_PROP_FPS)  # Lấy số frame trên mỗi giây của video
-    frame_count = 0
-    save_count = 0
-    frame_time = 1 / fps  # Thời gian của mỗi frame
-    interval_frame_count = int(frame_interval / frame_time)  # Số frame giữa mỗi lần cắt
-    # Load mô hình YOLOv8
-    model = YOLO('yolov8l.pt')  # Bạn có thể thay thế bằng phiên bản mô hình khác (yolov8s.pt, yolov8m.pt,...)
-
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        # Chỉ lưu frame sau mỗi khoảng thời gian 0.5 giây
-        if frame_count % interval_frame_count == 0:
-            # Lưu frame dưới dạng hình ảnh
-            frame_name = os.path.join(frame_output_folder, f"{save_count:06}.png")
-            cv2.imwrite(frame_name, frame)
-            print(f"Saved {frame_name}")
-            
-            # Chạy mô hình YOLOv8 trên frame
-            results = model(frame)
-            
-            # Tạo tên file .txt tương ứng
-            txt_path = os.path.join(label_output_folder, f"{save_count:06}.txt")
-
-            # Lưu bounding box vào file .txt theo định dạng yêu cầu
-            with open(txt_path, 'w') as f:
-                for result in results:
-                    boxes = result.boxes  # Lấy kết quả bounding box
-                    for box in boxes:
-                        cls = int(box.cls[0])  # Class ID
-                        
-                        # Chỉ lưu bounding box của class "person" (ID = 0)
-                        if cls == 0:
-                            # Chuẩn hóa tọa độ: Chia các giá trị cho kích thước của ảnh
-                            img_h, img_w = frame.shape[:2]  # Lấy chiều cao và chiều rộng của ảnh
-                            x_center = box.xywh[0][0] / img_w
-                            y_center = box.xywh[0][1] / img_h
-                            width = box.xywh[0][2] / img_w
-                            height = box.xywh[0][3] / img_h
-                            
-                            # Lưu vào file .txt với định dạng "0 class_id x_center y_center width height"
-                            f.write(f"0 {cls} {x_center:.6f} {y_center:.6f} {width:.6f} {height:.6f}\n")
-            
-            print(f"Saved {txt_path}")
+    # Load mô hình YOLOv8 nếu nơi gọi chưa truyền sẵn model (mỗi worker chỉ load một lần)
+    if model is None:
+        # Bạn có thể thay thế bằng phiên bản mô hình khác (yolov8s.pt, yolov8m.pt,...) hoặc backend ONNX
+        model = load_backend(model_path, **(backend_options or {}))
+    if isinstance(model, CascadeBackend):
+        # Thống kê escalate tính riêng cho từng video, tiếp tục từ checkpoint khi resume
+        model.reset()
+        if state and state.get('cascade'):
+            model.frames = state['cascade']['frames']
+            model.escalated = state['cascade']['escalated']
+
+    # Chỉ lưu frame sau mỗi khoảng thời gian frame_interval giây
+    frames = sample_frames(cap, frame_interval, sampling, start_ms)
+    submit = _run_now
+    writer = None
+    if pipeline:
+        # decode -> suy luận -> ghi file chạy song song, nối với nhau bằng các hàng đợi có giới hạn
+        frames = prefetch(frames, queue_size)
+        writer = BackgroundWriter(writer_threads, max_pending=queue_size + 2 * batch_size)
+        submit = writer.submit
+
+    tracker = None
+    if keyframe_interval > 0:
+        tracker = IoUTracker(**(tracker_options or {}))
+        if state and state.get('tracker'):
+            # Khôi phục cả các track đang theo dõi: checkpoint có thể rơi giữa hai keyframe
+            tracker.restore(state['tracker'])
+        elif state and state.get('next_track_id'):
+            # Checkpoint cũ chỉ có ID: tiếp tục đánh số để không trùng với các ID đã ghi
+            tracker.next_id = state['next_track_id']
+
+        def run_batch(batch):
+            track_batch(model, batch, label_output_folder, tracker, keyframe_interval, submit, conf_threshold)
+    else:
+        def run_batch(batch):
+            detect_batch(model, batch, label_output_folder, submit, conf_threshold, save_conf)
+
+    gate = ChangeGate(skip_threshold) if skip_threshold > 0 else None
+    if state:
+        _trim_frame_manifest(manifest_path, start_ms)
+        manifest_file = open(manifest_path, 'a', newline='')
+        manifest = csv.writer(manifest_file)
+    else:
+        manifest_file = open(manifest_path, 'w', newline='')
+        manifest = csv.writer(manifest_file)
+        manifest.writerow(['source_frame', 'timestamp_ms', 'saved_frame', 'status'])
+
+    interval_ms = frame_interval * 1000.0
+    last_timestamp = start_ms - interval_ms
+    last_checkpoint = save_count
+
+    def checkpoint(done):
+        # Chỉ ghi checkpoint khi mọi frame trước đó đã thật sự nằm trên đĩa
+        if writer is not None:
+            writer.drain()
+        manifest_file.flush()
+        write_json_atomic(progress_path, {
+            'save_count': save_count,
+            'resume_ms': last_timestamp + interval_ms,
+            'tracker': tracker.state() if tracker is not None else None,
+            'image_scale': image_scale,
+            'cascade': model.stats() if isinstance(model, CascadeBackend) else None,
+            'done': done,
+        })
+
+    # Các frame đã lưu nhưng chưa chạy mô hình, gom lại để chạy một lần theo batch_size
+    batch = []
+    completed = False
+
+    try:
+        for frame_index, timestamp, frame in frames:
+            last_timestamp = timestamp
+            if gate is not None and gate.is_static(frame):
+                # Frame bị bỏ trỏ tới frame đã lưu gần nhất mà nó trùng, số thứ tự frame đã lưu vẫn liên tục
+                manifest.writerow([frame_index, f"{timestamp:.3f}", f"{save_count - 1:06}", 'skipped'])
+                continue
+            manifest.writerow([frame_index, f"{timestamp:.3f}", f"{save_count:06}", 'kept'])
+
+            frame_name = os.path.join(frame_output_folder, f"{save_count:06}.{image_format}")
+            submit(save_frame, frame_name, frame, encode_params, image_scale)
+
+            batch.append((save_count, frame))
+            if len(batch) >= batch_size:
+                # Chạy mô hình YOLOv8 trên cả batch
+                run_batch(batch)
+                batch = []
+
             save_count += 1
-        
-        frame_count += 1
+            if not batch and save_count - last_checkpoint >= checkpoint_every:
+                checkpoint(done=False)
+                last_checkpoint = save_count
 
-    cap.release()
+        # Xử lý nốt các frame còn lại chưa đủ một batch
+        run_batch(batch)
+        checkpoint(done=True)
+        if isinstance(model, CascadeBackend):
+            stats = model.stats()
+            print(f"Cascade: escalated {stats['escalated']}/{stats['frames']} frames to {model_path}")
+        completed = True
+    finally:
+        if pipeline:
+            # Dừng thread decode trước khi giải phóng VideoCapture mà nó đang đọc
+            frames.close()
+        try:
+            if writer is not None:
+                writer.close()
+        except Exception:
+            # Khi vòng lặp đã lỗi, lỗi ghi không được che mất lỗi gốc đang được ném ra
+            if completed:
+                raise
+        finally:
+            manifest_file.close()
+            cap.release()
+    return save_count
     
 
-def process_all_videos(input_folder, frame_output_base, label_output_base, frame_interval=0.5):
+# Model của từng process worker, được load một lần trong _init_worker
+_worker_model = None
+
+
+def _init_worker(model_path, backend_options):
+    """Khởi tạo worker: load backend một lần, với số thread đã chia sẵn để các worker không tranh CPU."""
+    global _worker_model
+    _worker_model = load_backend(model_path, **backend_options)
+
+
+def _process_video_job(job):
+    """Xử lý một video trong worker, trả về (video_path, số frame đã lưu) cho process cha."""
+    video_path, frame_output_folder, label_output_folder, options = job
+    save_count = extract_and_detect(video_path, frame_output_folder, label_output_folder, model=_worker_model, **options)
+    return video_path, frame_output_folder, label_output_folder, save_count
+
+
+def _print_video_completed(video_path, frame_output_folder, label_output_folder):
+    print("--------------------------------------------------")
+    print(f"Video completed: {video_path.name}")
+    print(f"Video path: {frame_output_folder} and {label_output_folder}")
+    print("--------------------------------------------------")
+
+
+def _clear_outputs(*folders):
+    """Xóa ảnh và nhãn cũ của một video trước khi xử lý lại từ đầu (video hoặc tham số đã thay đổi)."""
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for file in os.listdir(folder):
+            if file.endswith(IMAGE_EXTENSIONS + ('.txt', '.csv', '.json')):
+                os.remove(os.path.join(folder, file))
+
+
+def process_all_videos(input_folder, frame_output_base, label_output_base, frame_interval=0.5, batch_size=1,
+                       sampling="auto", workers=1, model_path="yolov8l.pt", pipeline=False, keyframe_interval=0,
+                       tracker_options=None, skip_threshold=0, force=False, image_options=None, conf_threshold=0.0,
+                       save_conf=False, backend_options=None):
+    """Xử lý mọi video .mp4 trong input_folder, chỉ làm phần việc còn thiếu so với lần chạy trước.
+
+    label_output_base/CORPUS_MANIFEST_NAME ghi cho từng video: hash nội dung, tham số, thư mục NNNN được gán
+    và frame cuối cùng đã xong. Video đã xong với cùng hash và tham số được bỏ qua, video dở dang được tiếp tục,
+    video mới được gán số thư mục tiếp theo nên thêm video không làm xê dịch các thư mục cũ.
+    force=True xử lý lại mọi video từ đầu (vẫn giữ số thư mục đã gán).
+    backend_options: tham số của detector_backends.load_backend ('backend', 'imgsz', 'threads', 'cascade_model', ...).
+    """
+    backend_options = dict(backend_options or {})
     print("---PREPAIRING---")
     video_files = list(Path(input_folder).glob('*.mp4'))  # Lấy tất cả các video .mp4 trong thư mục
-    for i, video_path in enumerate(tqdm(video_files, desc="Processing videos", unit="video")):
-        # Tạo tên thư mục con cho mỗi video
-        frame_output_folder = os.path.join(frame_output_base, f"{i:04}")
-        label_output_folder = os.path.join(label_output_base, f"{i:04}")
-        print((video_path.name).upper())
-        # Gọi hàm xử lý cho từng video
-        extract_and_detect(video_path, frame_output_folder, label_output_folder, frame_interval)
-        print("--------------------------------------------------")
-        print(f"Video completed: {video_path.name}")
-        print(f"Video path: {frame_output_folder} and {label_output_folder}")
-        print("--------------------------------------------------")
-# Đường dẫn tới thư mục chứa video, thư mục cơ sở lưu trữ frame và nhãn
-input_folder = "video_data"
-frame_output_base = "images"
-label_output_base = "labels_with_ids"
-
-# Gọi hàm để xử lý tất cả video trong thư mục đầu vào
-process_all_videos(input_folder, frame_output_base, label_output_base, frame_interval=0.5)
+    options = {'frame_interval': frame_interval, 'batch_size': batch_size, 'sampling': sampling, 'pipeline': pipeline,
+               'keyframe_interval': keyframe_interval, 'tracker_options': tracker_options,
+               'skip_threshold': skip_threshold, 'image_options': image_options, 'conf_threshold': conf_threshold,
+               'save_conf': save_conf}
+    # Chỉ các tham số làm thay đổi kết quả trên đĩa; batch_size/pipeline/workers không tính
+    params = {'frame_interval': frame_interval, 'sampling': sampling, 'model': model_path,
+              'backend': {key: value for key, value in backend_options.items() if key != 'threads'},
+              'keyframe_interval': keyframe_interval, 'tracker_options': tracker_options,
+              'skip_threshold': skip_threshold, 'image_options': image_options, 'conf_threshold': conf_threshold,
+              'save_conf': save_conf}
+
+    os.makedirs(label_output_base, exist_ok=True)
+    manifest_path = os.path.join(label_output_base, CORPUS_MANIFEST_NAME)
+    manifest = read_json(manifest_path, {'videos': {}})
+    entries = manifest['videos']
+    next_folder = max((int(entry['folder']) for entry in entries.values()), default=-1) + 1
+
+    jobs = []
+    for video_path in video_files:
+        stat = video_path.stat()
+        entry = entries.get(video_path.name)
+        if entry is None:
+            entry = entries[video_path.name] = {'folder': f"{next_folder:04}", 'hash': None}
+            next_folder += 1
+        # Chỉ băm lại khi kích thước hoặc mtime đổi, băm video nhiều GB mỗi lần chạy cũng tốn kém
+        if entry['hash'] and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+            digest = entry['hash']
+        else:
+            digest = file_hash(video_path)
+
+        frame_output_folder = os.path.join(frame_output_base, entry['folder'])
+        label_output_folder = os.path.join(label_output_base, entry['folder'])
+        fresh = force or entry['hash'] != digest or entry.get('params') != params
+        if not fresh and entry.get('done'):
+            print(f"Skipped (already done): {video_path.name} -> {entry['folder']}")
+            continue
+        if fresh:
+            _clear_outputs(frame_output_folder, label_output_folder)
+            entry['last_frame'] = None
+        else:
+            state = read_json(os.path.join(label_output_folder, PROGRESS_NAME))
+            entry['last_frame'] = state['save_count'] - 1 if state else None
+        entry.update({'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime, 'params': params, 'done': False})
+        jobs.append((video_path, frame_output_folder, label_output_folder, dict(options, resume=not fresh)))
+    write_json_atomic(manifest_path, manifest)
+
+    def completed(video_path, frame_output_folder, label_output_folder, save_count):
+        _print_video_completed(video_path, frame_output_folder, label_output_folder)
+        entries[video_path.name].update({'done': True, 'last_frame': save_count - 1})
+        write_json_atomic(manifest_path, manifest)
+        progress.set_postfix(frames=save_count)
+        progress.update(1)
+
+    progress = tqdm(total=len(jobs), desc="Processing videos", unit="video")
+    if jobs and workers <= 1:
+        model = load_backend(model_path, **backend_options)
+        for video_path, frame_output_folder, label_output_folder, job_options in jobs:
+            print((video_path.name).upper())
+            # Gọi hàm xử lý cho từng video
+            save_count = extract_and_detect(video_path, frame_output_folder, label_output_folder, model=model,
+                                            **job_options)
+            completed(video_path, frame_output_folder, label_output_folder, save_count)
+    elif jobs:
+        # Chia đều số core cho các worker để backend trong mỗi worker không tự dùng hết CPU
+        if not backend_options.get('threads'):
+            backend_options['threads'] = max(1, (os.cpu_count() or 1) // workers)
+        # Export/lượng tử hóa ONNX một lần ở đây, các worker chỉ load file đã có
+        backend = backend_options.get('backend', "torch")
+        imgsz = backend_options.get('imgsz', 640)
+        worker_model_path = prepare_model(model_path, backend, imgsz)
+        if backend_options.get('cascade_model'):
+            backend_options['cascade_model'] = prepare_model(backend_options['cascade_model'], backend, imgsz)
+        with Pool(workers, initializer=_init_worker, initargs=(worker_model_path, backend_options)) as pool:
+            # Worker lấy video tiếp theo ngay khi xong video trước, process cha gom tiến độ vào một thanh tqdm
+            for result in pool.imap_unordered(_process_video_job, jobs):
+                completed(*result)
+    progress.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cắt frame từ video và pre-label người bằng YOLOv8")
+    # Đường dẫn tới thư mục chứa video, thư mục cơ sở lưu trữ frame và nhãn
+    parser.add_argument("--input", default="video_data", help="Thư mục chứa video .mp4")
+    parser.add_argument("--frames", default="images", help="Thư mục cơ sở lưu frame")
+    parser.add_argument("--labels", default="labels_with_ids", help="Thư mục cơ sở lưu nhãn")
+    parser.add_argument("--interval", type=float, default=0.5, help="Khoảng thời gian (giây) giữa hai frame được cắt")
+    parser.add_argument("--batch-size", type=int, default=8,
+                        help="Số frame gom lại cho mỗi lần chạy YOLO (1 = chạy từng frame như cũ)")
+    parser.add_argument("--sampling", default="auto", choices=["auto", "read", "grab", "seek"],
+                        help="Cách lấy mẫu frame: read (decode mọi frame như cũ), grab, seek hoặc auto")
+    parser.add_argument("--workers", type=int, default=1, help="Số process xử lý video song song")
+    parser.add_argument("--model", default="yolov8l.pt", help="Đường dẫn model YOLOv8")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Chạy decode, suy luận và ghi file song song qua các hàng đợi có giới hạn")
+    parser.add_argument("--keyframe-interval", type=int, default=0,
+                        help="Chỉ chạy YOLO mỗi K frame lấy mẫu và dùng tracker cho các frame ở giữa (0 = tắt)")
+    parser.add_argument("--track-iou", type=float, default=0.3, help="IoU tối thiểu để ghép detection với track")
+    parser.add_argument("--track-max-misses", type=int, default=1,
+                        help="Số keyframe liên tiếp một track được phép mất detection trước khi bị xóa")
+    parser.add_argument("--track-max-distance", type=float, default=1.5,
+                        help="Khoảng cách tâm tối đa (theo kích thước box) để ghép track mới chưa có vận tốc")
+    parser.add_argument("--track-alpha", type=float, default=0.85, help="Hệ số alpha (vị trí) của bộ lọc tracker")
+    parser.add_argument("--track-beta", type=float, default=0.3, help="Hệ số beta (vận tốc) của bộ lọc tracker")
+    parser.add_argument("--force", action="store_true",
+                        help="Bỏ qua manifest, xử lý lại mọi video từ đầu (vẫn giữ số thư mục đã gán)")
+    parser.add_argument("--skip-threshold", type=float, default=0,
+                        help="Bỏ frame có độ lệch ảnh xám thu nhỏ (0-255) so với frame giữ trước đó nhỏ hơn ngưỡng (0 = tắt)")
+    parser.add_argument("--image-format", default="png", choices=["png", "jpg", "webp"], help="Định dạng ảnh frame lưu ra")
+    parser.add_argument("--image-quality", type=int, default=None, help="Chất lượng JPEG/WebP (0-100)")
+    parser.add_argument("--png-compression", type=int, default=None, help="Mức nén PNG (0-9, thấp hơn = ghi nhanh hơn)")
+    parser.add_argument("--image-scale", type=float, default=1.0, help="Tỉ lệ thu nhỏ ảnh lưu (vd. 0.5)")
+    parser.add_argument("--conf-threshold", type=float, default=0.0, help="Chỉ ghi box person có confidence >= ngưỡng")
+    parser.add_argument("--save-conf", action="store_true", help="Ghi thêm confidence làm cột thứ 7 của file nhãn")
+    parser.add_argument("--backend", default="torch", choices=BACKENDS,
+                        help="Backend suy luận: torch (PyTorch), onnx (ONNX Runtime) hoặc onnx-int8 (lượng tử hóa)")
+    parser.add_argument("--imgsz", type=int, default=640, help="Kích thước đầu vào của model")
+    parser.add_argument("--threads", type=int, default=None, help="Số thread suy luận cho mỗi process")
+    parser.add_argument("--cascade-model", default=None,
+                        help="Model nhỏ chạy mọi frame (vd. yolov8n.pt); --model chỉ chạy lại các frame không chắc chắn")
+    parser.add_argument("--cascade-low", type=float, default=0.1,
+                        help="Box person của model nhỏ có conf trong [low, high) làm frame bị escalate")
+    parser.add_argument("--cascade-high", type=float, default=0.5,
+                        help="Box person của model nhỏ có conf trong [low, high) làm frame bị escalate")
+    args = parser.parse_args()
+    tracker_options = {'iou_threshold': args.track_iou, 'max_misses': args.track_max_misses,
+                       'max_distance': args.track_max_distance, 'alpha': args.track_alpha, 'beta': args.track_beta}
+    image_options = {'format': args.image_format, 'quality': args.image_quality,
+                     'png_compression': args.png_compression, 'scale': args.image_scale}
+
+    # Gọi hàm để xử lý tất cả video trong thư mục đầu vào
+    process_all_videos(args.input, args.frames, args.labels, frame_interval=args.interval, batch_size=args.batch_size,
+                       sampling=args.sampling, workers=args.workers, model_path=args.model,
+                       pipeline=args.pipeline, keyframe_interval=args.keyframe_interval,
+                       tracker_options=tracker_options, skip_threshold=args.skip_threshold,
+                       force=args.force, image_options=image_options, conf_threshold=args.conf_threshold,
+                       save_conf=args.save_conf,
+                       backend_options={'backend': args.backend, 'imgsz': args.imgsz, 'threads': args.threads,
+                                        'cascade_model': args.cascade_model, 'cascade_low': args.cascade_low,
+                                        'cascade_high': args.cascade_high})
@@ -1,75 +1,125 @@
-import csv
 import os
-import random
+import zlib
 from pathlib import Path
+from element_store import open_store, read_rows, video_key
 
-def generate_prompts(elements_folder, prompts_output_folder):
-    # Tạo folder đầu ra nếu nó không tồn tại
-    if not os.path.exists(prompts_output_folder):
-        os.makedirs(prompts_output_folder)
+# Định nghĩa các mẫu đa dạng cho các prompt
+templates = [
+    "A person wearing a {color} who is {action}.",
+    "{action} person in a {color}.",
+    "Someone with a {color}, {action}.",
+    "A person in a {color} engaged in {action}.",
+    "The person wearing a {color} and {action}.",
+    "An individual in {color} doing {action}."
+]
 
+def generate_prompts(elements_folder, prompts_output_folder):
     # Danh sách để lưu các đường dẫn tệp _prompts.txt được tạo ra
     generated_files = []
 
-    # Định nghĩa các mẫu đa dạng cho các prompt
-    templates = [
-        "A person wearing a {color} who is {action}.",
-        "{action} person in a {color}.",
-        "Someone with a {color}, {action}.",
-        "A person in a {color} engaged in {action}.",
-        "The person wearing a {color} and {action}.",
-        "An individual in {color} doing {action}."
-    ]
-
-    # Lấy danh sách tất cả các file .csv trong folder elements
-    csv_files = [f for f in os.listdir(elements_folder) if f.endswith('.csv')]
-
-    # Xử lý từng file CSV
-    for elements_file in csv_files:
-        prompts = []
-        csv_path = os.path.join(elements_folder, elements_file)
-        with open(csv_path, mode='r') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                frame_id = row.get('frame_id')
-                class_id = row.get('class_id')
-                color = row.get('color')
-                action = row.get('action')
-
-                # Chọn ngẫu nhiên một template
-                template = random.choice(templates)
-
-                # Thay thế các placeholder bằng giá trị thực tế và viết hoa chữ cái đầu nếu cần
-                if color and action:
-                    prompt = template.format(color=color, action=action)
-                    # Viết hoa ký tự đầu tiên nếu không được viết hoa
-                    prompt = prompt[0].upper() + prompt[1:]
-                elif color:
-                    prompt = f"A person wearing a {color}."
-                elif action:
-                    prompt = f"A person who is {action}."
-                else:
-                    prompt = f"A person."
-
-                prompts.append(prompt)
-
-        # Lưu các prompt vào một file mới trong folder đầu ra
-        prompts_file_name = f"{os.path.splitext(elements_file)[0]}_prompts.txt"
-        prompts_file_path = os.path.join(prompts_output_folder, prompts_file_name)
-        with open(prompts_file_path, mode='w') as file:
-            for prompt in prompts:
-                file.write(prompt + '\n')
-
-        # Chuẩn hóa đường dẫn và in ra
-        normalized_path = os.path.normpath(prompts_file_path)
-        print(f"Generated prompts file at: {normalized_path}")
-
-        # Thêm đường dẫn tệp đã tạo vào danh sách
-        generated_files.append(normalized_path)
+    # Lấy danh sách tất cả các file elements_N.csv trong folder elements
+    csv_files = [f for f in os.listdir(elements_folder) if video_key(f) is not None]
+
+    # Đọc từ store chung mà label_tool đang ghi vào (CSV chỉ được export khi đóng tool);
+    # file CSV bị sửa bên ngoài store được import lại trước
+    store = open_store(elements_folder)
+    try:
+        # Xử lý từng file CSV
+        for elements_file in csv_files:
+            csv_path = os.path.join(elements_folder, elements_file)
+            generated_files.append(generate_prompt_file(csv_path, prompts_output_folder, store))
+    finally:
+        store.close()
 
     # Trả về danh sách các đường dẫn tệp _prompts.txt đã được tạo
     return generated_files
 
+def prompt_file_for(csv_path, prompts_output_folder):
+    """Đường dẫn file _prompts.txt ứng với một file elements CSV."""
+    elements_file = os.path.basename(csv_path)
+    prompts_file_name = f"{os.path.splitext(elements_file)[0]}_prompts.txt"
+    return os.path.normpath(os.path.join(prompts_output_folder, prompts_file_name))
+
+def iter_attribute_spans(csv_path, store=None):
+    """Gom các dòng của một file elements CSV theo trạng thái (class_id, color, action).
+
+    Có store (element_store.ElementStore) thì đọc các dòng của video đó từ store thay vì đọc file CSV.
+
+    Generator trả về lần lượt mỗi trạng thái một dict {'class_id', 'color', 'action', 'frames', 'ranges'},
+    theo thứ tự xuất hiện đầu tiên; 'ranges' là các khoảng frame liên tiếp [(start, end), ...] (tính cả end).
+    Chỉ giữ trong bộ nhớ các frame id, không giữ cả các dòng CSV.
+    """
+    states = {}
+    for row in read_rows(csv_path, store):
+        key = (int(row['class_id']), row.get('color') or '', row.get('action') or '')
+        states.setdefault(key, set()).add(int(row['frame_id']))
+
+    for (class_id, color, action), frames in states.items():
+        ranges = []
+        for frame in sorted(frames):
+            if ranges and frame == ranges[-1][1] + 1:
+                ranges[-1][1] = frame
+            else:
+                ranges.append([frame, frame])
+        yield {
+            'class_id': class_id,
+            'color': color,
+            'action': action,
+            'frames': len(frames),
+            'ranges': [tuple(frame_range) for frame_range in ranges],
+        }
+
+def make_prompt(color, action):
+    """Một prompt theo templates cho một cặp color/action (có thể rỗng).
+
+    Template được chọn theo chính cặp color/action nên cùng thuộc tính luôn cho cùng một câu, qua mọi lần chạy:
+    sửa nhãn rồi chạy lại không làm đổi các câu gốc còn lại (cache paraphrase vẫn trúng), và hai người cùng
+    thuộc tính cho cùng một câu để expression.py gộp lại.
+    """
+    # Chọn template theo hash của color/action thay vì ngẫu nhiên
+    template = templates[zlib.crc32(f"{color}\0{action}".encode('utf-8')) % len(templates)]
+
+    # Thay thế các placeholder bằng giá trị thực tế và viết hoa chữ cái đầu nếu cần
+    if color and action:
+        prompt = template.format(color=color, action=action)
+        # Viết hoa ký tự đầu tiên nếu không được viết hoa
+        prompt = prompt[0].upper() + prompt[1:]
+    elif color:
+        prompt = f"A person wearing a {color}."
+    elif action:
+        prompt = f"A person who is {action}."
+    else:
+        prompt = f"A person."
+    return prompt
+
+def iter_prompts(csv_path, store=None):
+    """Generator (prompt, span): một prompt cho mỗi trạng thái thuộc tính của iter_attribute_spans."""
+    for span in iter_attribute_spans(csv_path, store):
+        yield make_prompt(span['color'], span['action']), span
+
+def generate_prompt_file(csv_path, prompts_output_folder, store=None):
+    """Tạo file _prompts.txt cho một file elements CSV; trả về đường dẫn file đã tạo.
+
+    Một người xuất hiện trong 500 frame với thuộc tính không đổi chỉ cho một prompt thay vì 500 prompt.
+    """
+    return write_prompt_file(csv_path, prompts_output_folder, (prompt for prompt, _ in iter_prompts(csv_path, store)))
+
+def write_prompt_file(csv_path, prompts_output_folder, prompts):
+    """Ghi các prompt đã tạo (ví dụ từ iter_prompts) vào file _prompts.txt của csv_path; trả về đường dẫn file."""
+    # Tạo folder đầu ra nếu nó không tồn tại
+    os.makedirs(prompts_output_folder, exist_ok=True)
+
+    # Lưu các prompt vào một file mới trong folder đầu ra
+    prompts_file_path = prompt_file_for(csv_path, prompts_output_folder)
+    with open(prompts_file_path, mode='w') as file:
+        for prompt in prompts:
+            file.write(prompt + '\n')
+
+    # Chuẩn hóa đường dẫn và in ra
+    normalized_path = os.path.normpath(prompts_file_path)
+    print(f"Generated prompts file at: {normalized_path}")
+    return normalized_path
+
 # elements_folder = "elements"  # Đường dẫn đến thư mục elements
 # prompts_output_folder = "prompt_gen"
 # generate_prompts(elements_folder, prompts_output_folder)
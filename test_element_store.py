@@ -0,0 +1,77 @@
+"""Tests of element_store: the order rows are stored in, and journal recovery after a crash."""
+import csv
+
+from element_store import ELEMENT_COLUMNS, ElementModel, ElementStore
+
+
+def make_model(tmp_path, video="0"):
+    store = ElementStore(str(tmp_path / "elements.sqlite"))
+    return store, ElementModel(store, video, str(tmp_path / f"elements_{video}.journal"))
+
+
+def row(frame_id, class_id, color="", action=""):
+    return {'frame_id': frame_id, 'class_id': class_id, 'color': color, 'action': action, 'gender': ''}
+
+
+def test_flush_keeps_creation_order(tmp_path):
+    store, model = make_model(tmp_path)
+    frames = [5, 3, 1, 7, 2]
+    for frame_id in frames:
+        model.set_rows([row(frame_id, 9, color=f"color {frame_id}")])
+    assert model.first_per_class()[9]['frame_id'] == 5
+    model.flush()
+    store.close()
+
+    store, model = make_model(tmp_path)
+    assert [stored['frame_id'] for stored in store.all_rows("0")] == frames
+    assert model.first_per_class()[9]['frame_id'] == 5
+
+    csv_path = tmp_path / "elements_0.csv"
+    store.export_csv("0", str(csv_path))
+    with open(csv_path, newline='') as file:
+        assert [int(exported['frame_id']) for exported in csv.DictReader(file)] == frames
+
+
+def test_updates_keep_the_row_position(tmp_path):
+    store, model = make_model(tmp_path)
+    model.set_rows([row(0, 1, "red jacket"), row(0, 2, "blue jacket")])
+    model.flush()
+    model.set_rows([row(1, 3, "black shirt"), row(0, 1, "white jacket")])
+    model.flush()
+    assert [(stored['frame_id'], stored['class_id'], stored['color']) for stored in store.all_rows("0")] == [
+        (0, 1, "white jacket"), (0, 2, "blue jacket"), (1, 3, "black shirt")]
+
+
+def test_recover_replays_an_unflushed_journal(tmp_path):
+    store, model = make_model(tmp_path)
+    model.set_rows([row(0, 1, "red jacket", "walking"), row(0, 2, "blue jacket")])
+    model.flush()
+    # Changes after the last flush only exist in the journal when the tool crashes
+    model.set_rows([row(1, 1, "red jacket", "standing"), row(2, 1, "red jacket", "buying")])
+    model.set_rows([row(0, 2, "black jacket")])
+    model.delete_from(2)
+    model.journal.close()
+    assert (tmp_path / "elements_0.journal").exists()
+
+    store = ElementStore(str(tmp_path / "elements.sqlite"))
+    assert len(store.all_rows("0")) == 2
+    recovered = ElementModel(store, "0", str(tmp_path / "elements_0.journal"))
+    assert not (tmp_path / "elements_0.journal").exists()
+    assert [(stored['frame_id'], stored['class_id'], stored['color'], stored['action'])
+            for stored in store.all_rows("0")] == [
+        (0, 1, "red jacket", "walking"), (0, 2, "black jacket", ""), (1, 1, "red jacket", "standing")]
+    assert set(recovered.frame(1)) == {1}
+    assert recovered.frame(2) == {}
+
+
+def test_recover_ignores_a_torn_last_line(tmp_path):
+    store, model = make_model(tmp_path)
+    model.set_rows([row(0, 1, "red jacket")])
+    model.journal.close()
+    with open(tmp_path / "elements_0.journal", 'a') as journal:
+        journal.write('{"op": "upsert", "row": {"frame_id": 1')
+
+    recovered = ElementModel(store, "0", str(tmp_path / "elements_0.journal"))
+    assert [[stored[column] for column in ELEMENT_COLUMNS] for stored in store.all_rows("0")] == [
+        [0, 1, "red jacket", "", ""]]
+    assert set(recovered.frame(0)) == {1}
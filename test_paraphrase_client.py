@@ -0,0 +1,156 @@
+"""Tests of ParaphraseClient against a local OpenAI-compatible stub server (api_base), no network or API key needed."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("openai")
+
+from paraphrase_client import ParaphraseClient, RateLimiter  # noqa: E402
+
+RETRY_AFTER = 0.2  # Seconds the stub asks for in its 429 responses
+
+
+class StubServer(ThreadingHTTPServer):
+    """Chat-completion stub: the first request for each sentence gets 429 with Retry-After, later ones n choices."""
+
+    daemon_threads = True
+
+    def __init__(self, rate_limit_first=True, delay=0.0, status=None):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.rate_limit_first = rate_limit_first
+        self.delay = delay
+        self.status = status  # Fixed error status for every request, e.g. 400
+        self.lock = threading.Lock()
+        self.requests = []  # (time, sentence, n, status)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def api_base(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def attempts(self, sentence):
+        return [request for request in self.requests if request[1] == sentence]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, headers=()):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        sentence = body["messages"][-1]["content"].split("'")[1]
+        n = body.get("n", 1)
+        with server.lock:
+            first = not server.attempts(sentence)
+            status = server.status or (429 if first and server.rate_limit_first else 200)
+            server.requests.append((time.monotonic(), sentence, n, status))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.delay)
+            if status != 200:
+                self._send(status, {"error": {"message": "stub error", "type": "stub", "param": None, "code": None}},
+                           [("Retry-After", str(RETRY_AFTER))] if status == 429 else [])
+                return
+            choices = [
+                {"index": i, "finish_reason": "stop",
+                 "message": {"role": "assistant", "content": f"{i + 1}. Paraphrase {i} of {sentence}"}}
+                for i in range(n)
+            ]
+            self._send(200, {"id": "stub", "object": "chat.completion", "created": 0, "model": body["model"],
+                             "choices": choices,
+                             "usage": {"prompt_tokens": 1, "completion_tokens": n, "total_tokens": n + 1}})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(**options):
+        server = StubServer(**options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_client(server, **options):
+    return ParaphraseClient(api_base=server.api_base, api_key="test", timeout=5, **options)
+
+
+def test_rate_limited_request_is_retried_after_retry_after(stub):
+    server = stub()
+    paraphrases = make_client(server, max_retries=2).paraphrase("A person in a red jacket.", 3)
+
+    attempts = server.attempts("A person in a red jacket.")
+    assert [status for _, _, _, status in attempts] == [429, 200]
+    # The wait comes from the server's Retry-After header, not the (longer) default backoff
+    assert RETRY_AFTER <= attempts[1][0] - attempts[0][0] < 0.5
+    assert [n for _, _, n, _ in attempts] == [3, 3]
+    assert paraphrases == [f"Paraphrase {i} of A person in a red jacket." for i in range(3)]
+
+
+def test_gives_up_after_max_retries(stub):
+    server = stub(status=429)
+    assert make_client(server, max_retries=1).paraphrase("A person.", 2) == []
+    assert len(server.requests) == 2
+
+
+def test_client_errors_are_not_retried(stub):
+    server = stub(status=400)
+    assert make_client(server, max_retries=3).paraphrase("A person.", 2) == []
+    assert len(server.requests) == 1
+
+
+def test_server_errors_back_off_exponentially(stub):
+    server = stub(status=500)
+    make_client(server, max_retries=2, backoff_base=0.1).paraphrase("A person.")
+    times = [request_time for request_time, _, _, _ in server.requests]
+    assert len(times) == 3
+    # Jittered 0.1 * 2^attempt, between half and the full delay
+    assert times[1] - times[0] >= 0.05
+    assert times[2] - times[1] >= 0.1
+
+
+def test_map_bounds_concurrent_requests(stub):
+    server = stub(rate_limit_first=False, delay=0.1)
+    client = make_client(server, concurrency=3)
+    sentences = [f"Sentence number {i}." for i in range(9)]
+
+    results = client.map(lambda sentence: client.paraphrase(sentence, 2), sentences)
+
+    assert server.max_in_flight == 3
+    assert len(server.requests) == 9
+    assert [len(paraphrases) for paraphrases in results] == [2] * 9
+    assert results[4][0] == "Paraphrase 0 of Sentence number 4."
+
+
+def test_rate_limiter_spaces_requests():
+    limiter = RateLimiter(requests_per_minute=600)  # Bucket of 600, refilled at 10 per second
+    limiter.request_bucket[1] = 0
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.25
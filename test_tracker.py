@@ -0,0 +1,100 @@
+"""Kiểm tra tracker.IoUTracker trên chuỗi box tổng hợp, chạy theo đúng cách track_batch gọi (update tại keyframe,
+predict ở giữa)."""
+import json
+
+import pytest
+
+from tracker import IoUTracker
+
+K = 5  # keyframe_interval
+
+
+def run(tracker, boxes_per_frame, keyframe_interval=K):
+    """[(frame, [(track_id, box), ...]), ...] cho chuỗi detection boxes_per_frame[frame] = [box, ...]."""
+    output = []
+    for frame, detections in enumerate(boxes_per_frame):
+        if frame % keyframe_interval == 0:
+            output.append((frame, tracker.update(detections)))
+        else:
+            output.append((frame, tracker.predict()))
+    return output
+
+
+def moving_box(frame, speed, x0=0.2, y=0.5, w=0.05, h=0.2):
+    return [x0 + speed * frame, y, w, h]
+
+
+@pytest.mark.parametrize("speed", [0.004, 0.01])
+def test_keyframes_write_raw_detections(speed):
+    frames = [[moving_box(frame, speed)] for frame in range(21)]
+    output = run(IoUTracker(), frames)
+    for frame, boxes in output:
+        if frame % K == 0:
+            assert len(boxes) == 1
+            assert boxes[0][1] == pytest.approx(tuple(frames[frame][0]))
+
+
+def test_propagated_frames_follow_motion():
+    frames = [[moving_box(frame, 0.01)] for frame in range(21)]
+    output = run(IoUTracker(), frames)
+    # Sau keyframe thứ hai tracker đã biết vận tốc, frame ở giữa không còn là bản sao của keyframe trước
+    for frame, boxes in output[K + 1:]:
+        assert boxes[0][1][0] == pytest.approx(frames[frame][0][0])
+
+
+@pytest.mark.parametrize("speed", [0.0, 0.005, 0.01])
+def test_id_persists_while_moving(speed):
+    # speed 0.01 với K=5 là lệch đúng một chiều rộng box giữa hai keyframe, IoU bằng 0
+    frames = [[moving_box(frame, speed)] for frame in range(31)]
+    output = run(IoUTracker(), frames)
+    assert {track_id for _, boxes in output for track_id, _ in boxes} == {1}
+
+
+def test_two_people_keep_their_ids():
+    frames = [[moving_box(frame, 0.01, x0=0.1), moving_box(frame, -0.01, x0=0.9)] for frame in range(21)]
+    output = run(IoUTracker(), frames)
+    for frame, boxes in output:
+        by_id = dict(boxes)
+        assert set(by_id) == {1, 2}
+        assert by_id[1][0] < by_id[2][0]
+
+
+def test_missed_keyframe_hides_then_recovers_track():
+    frames = [[moving_box(frame, 0.002)] for frame in range(21)]
+    frames[10] = []  # YOLO bỏ sót người ở keyframe 10
+    output = dict(run(IoUTracker(max_misses=1), frames))
+    assert output[10] == []
+    assert [track_id for track_id, _ in output[15]] == [1]
+    assert output[15][0][1] == pytest.approx(tuple(frames[15][0]))
+
+
+def test_track_expires_after_max_misses():
+    frames = [[moving_box(frame, 0.0)] for frame in range(6)] + [[] for _ in range(10)] + [[moving_box(0, 0.0)]]
+    tracker = IoUTracker(max_misses=1)
+    output = dict(run(tracker, frames[:16]))
+    assert output[10] == [] and output[15] == []
+    assert tracker.tracks == []
+    # Người xuất hiện lại sau khi track đã bị xóa nhận ID mới
+    assert [track_id for track_id, _ in tracker.update(frames[16])] == [2]
+
+
+def test_first_id_continues_numbering():
+    tracker = IoUTracker(first_id=7)
+    assert [track_id for track_id, _ in tracker.update([moving_box(0, 0.0), moving_box(0, 0.0, x0=0.7)])] == [7, 8]
+    assert tracker.next_id == 9
+
+
+def test_restored_state_continues_between_keyframes():
+    frames = [[moving_box(frame, 0.01)] for frame in range(21)]
+    expected = run(IoUTracker(), frames)
+    # Checkpoint giữa hai keyframe (sau frame 11), khôi phục qua JSON như progress.json của pre_label_tool
+    tracker = IoUTracker()
+    run(tracker, frames[:12])
+    resumed = IoUTracker()
+    resumed.restore(json.loads(json.dumps(tracker.state())))
+    output = []
+    for frame in range(12, 21):
+        output.append((frame, resumed.update(frames[frame]) if frame % K == 0 else resumed.predict()))
+    for (frame, boxes), (_, expected_boxes) in zip(output, expected[12:]):
+        assert [track_id for track_id, _ in boxes] == [track_id for track_id, _ in expected_boxes] == [1]
+        assert boxes[0][1] == pytest.approx(expected_boxes[0][1])
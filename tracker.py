@@ -0,0 +1,169 @@
+"""Tracker IoU nhẹ chạy trên CPU, dùng để lan truyền bounding box và ID giữa các keyframe.
+
+Box luôn ở dạng chuẩn hóa (x_center, y_center, width, height) giống file labels_with_ids.
+Mỗi track giữ vị trí và vận tốc theo bộ lọc alpha-beta (dạng Kalman đơn giản với hệ số cố định):
+giữa hai keyframe box được dự đoán bằng vận tốc, tại keyframe detection được ghép với track theo IoU.
+Bộ lọc chỉ dùng để dự đoán: tại keyframe, box trả về là chính detection đã ghép với track.
+"""
+import math
+
+
+def iou(box_a, box_b):
+    """IoU của hai box dạng (x_center, y_center, width, height)."""
+    ax1, ay1 = box_a[0] - box_a[2] / 2, box_a[1] - box_a[3] / 2
+    ax2, ay2 = box_a[0] + box_a[2] / 2, box_a[1] + box_a[3] / 2
+    bx1, by1 = box_b[0] - box_b[2] / 2, box_b[1] - box_b[3] / 2
+    bx2, by2 = box_b[0] + box_b[2] / 2, box_b[1] + box_b[3] / 2
+    inter_w = min(ax2, bx2) - max(ax1, bx1)
+    inter_h = min(ay2, by2) - max(ay1, by1)
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    inter = inter_w * inter_h
+    union = box_a[2] * box_a[3] + box_b[2] * box_b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _clip_box(box, min_size=1e-4):
+    """Giữ tâm box trong ảnh và kích thước dương sau khi dự đoán."""
+    x, y, w, h = box
+    return [min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0), max(w, min_size), max(h, min_size)]
+
+
+def center_distance(box_a, box_b):
+    """Khoảng cách tâm của hai box, tính theo chiều rộng/cao của box_a (1.0 = lệch đúng một box)."""
+    return math.hypot((box_b[0] - box_a[0]) / box_a[2], (box_b[1] - box_a[1]) / box_a[3])
+
+
+class Track:
+    def __init__(self, track_id, box):
+        self.track_id = track_id
+        self.box = list(box)  # Vị trí đã lọc, gốc để dự đoán các frame sau
+        self.detection = list(box)  # Detection gần nhất đã ghép, box được ghi ra tại keyframe
+        self.velocity = [0.0, 0.0, 0.0, 0.0]  # Thay đổi của box sau mỗi frame lấy mẫu
+        self.steps = 0  # Số lần predict kể từ lần cập nhật bằng detection gần nhất
+        self.misses = 0  # Số keyframe liên tiếp không ghép được detection
+        self.hits = 1  # Số detection đã ghép; track mới (hits == 1) chưa có vận tốc
+
+    def predict(self):
+        self.box = _clip_box([b + v for b, v in zip(self.box, self.velocity)])
+        self.steps += 1
+
+    def correct(self, box, alpha, beta):
+        """Cập nhật alpha-beta: kéo box về detection và chỉnh vận tốc theo sai số chia đều cho các bước đã đi."""
+        steps = max(1, self.steps)
+        residual = [d - p for d, p in zip(box, self.box)]
+        if self.hits == 1:
+            # Lần ghép thứ hai: chưa có vận tốc để lọc, lấy thẳng độ dời giữa hai detection
+            self.box = list(box)
+            self.velocity = [r / steps for r in residual]
+        else:
+            self.box = _clip_box([p + alpha * r for p, r in zip(self.box, residual)])
+            self.velocity = [v + beta * r / steps for v, r in zip(self.velocity, residual)]
+        self.detection = list(box)
+        self.steps = 0
+        self.misses = 0
+        self.hits += 1
+
+    def state(self):
+        return {'track_id': self.track_id, 'box': self.box, 'detection': self.detection, 'velocity': self.velocity,
+                'steps': self.steps, 'misses': self.misses, 'hits': self.hits}
+
+    @classmethod
+    def from_state(cls, state):
+        track = cls(state['track_id'], state['box'])
+        track.detection = list(state['detection'])
+        track.velocity = list(state['velocity'])
+        track.steps = state['steps']
+        track.misses = state['misses']
+        track.hits = state['hits']
+        return track
+
+
+class IoUTracker:
+    """Ghép detection với track theo IoU (tham lam, IoU cao ghép trước) và lan truyền track giữa các keyframe.
+
+    iou_threshold: IoU tối thiểu giữa box dự đoán và detection để coi là cùng một người.
+    max_misses: số keyframe liên tiếp một track được phép không có detection trước khi bị xóa.
+    max_distance: với track mới chưa có vận tốc (box dự đoán chưa dịch chuyển), detection không đủ IoU vẫn được ghép
+        nếu tâm lệch không quá max_distance lần kích thước box, để người di chuyển nhanh giữa hai keyframe đầu giữ ID.
+    alpha, beta: hệ số bộ lọc alpha-beta cho vị trí và vận tốc (alpha=1, beta=0 là chỉ dùng detection, không dự đoán).
+    first_id: ID của track đầu tiên; mặc định 1 vì label_tool coi ID 0 là chưa gán.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_misses=1, alpha=0.85, beta=0.3, first_id=1, max_distance=1.5):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.max_distance = max_distance
+        self.alpha = alpha
+        self.beta = beta
+        self.next_id = first_id
+        self.tracks = []
+
+    def state(self):
+        """Trạng thái tracker dạng JSON được (checkpoint của pre_label_tool), khôi phục bằng restore()."""
+        return {'next_id': self.next_id, 'tracks': [track.state() for track in self.tracks]}
+
+    def restore(self, state):
+        self.next_id = state['next_id']
+        self.tracks = [Track.from_state(track) for track in state['tracks']]
+
+    def predict(self):
+        """Frame không chạy detector: dự đoán vị trí mới, trả về [(track_id, box), ...] của các track đang thấy."""
+        for track in self.tracks:
+            track.predict()
+        return [(track.track_id, tuple(track.box)) for track in self.tracks if track.misses == 0]
+
+    def _match(self, pairs, matched_tracks, matched_detections, detections):
+        """Ghép tham lam theo thứ tự pairs [(_, t, d), ...] đã sắp, bỏ qua track/detection đã được ghép."""
+        for _, t, d in pairs:
+            if t in matched_tracks or d in matched_detections:
+                continue
+            self.tracks[t].correct(detections[d], self.alpha, self.beta)
+            matched_tracks.add(t)
+            matched_detections.add(d)
+
+    def update(self, detections):
+        """Keyframe: ghép detections [box, ...] với các track, trả về [(track_id, detection), ...] của các track đang thấy."""
+        for track in self.tracks:
+            track.predict()
+
+        pairs = []
+        for t, track in enumerate(self.tracks):
+            for d, det in enumerate(detections):
+                overlap = iou(track.box, det)
+                if overlap >= self.iou_threshold:
+                    pairs.append((overlap, t, d))
+        pairs.sort(reverse=True)
+
+        matched_tracks = set()
+        matched_detections = set()
+        self._match(pairs, matched_tracks, matched_detections, detections)
+
+        # Track mới chưa biết vận tốc nên box dự đoán đứng yên: ghép thêm theo khoảng cách tâm, gần nhất trước
+        pairs = []
+        for t, track in enumerate(self.tracks):
+            if t in matched_tracks or track.hits > 1:
+                continue
+            for d, det in enumerate(detections):
+                if d in matched_detections:
+                    continue
+                distance = center_distance(track.box, det)
+                if distance <= self.max_distance:
+                    pairs.append((distance, t, d))
+        pairs.sort()
+        self._match(pairs, matched_tracks, matched_detections, detections)
+
+        survivors = []
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    continue
+            survivors.append(track)
+        self.tracks = survivors
+
+        for d, det in enumerate(detections):
+            if d not in matched_detections:
+                self.tracks.append(Track(self.next_id, det))
+                self.next_id += 1
+        return [(track.track_id, tuple(track.detection)) for track in self.tracks if track.misses == 0]